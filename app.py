@@ -1,6 +1,6 @@
-from flask import Flask, render_template, request, jsonify, Response, make_response
-from openai import OpenAI
+from flask import Flask, Blueprint, render_template, request, jsonify, Response, make_response, g
 import os
+import logging
 import time
 import json
 import re
@@ -11,30 +11,56 @@ from uuid import UUID
 from urllib.parse import urlparse, parse_qs
 from urllib.request import urlopen
 import html
+import csv
+import codecs
+import io
 import base64
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import hashlib
+import zlib
+import random
+import threading
+import queue
+import sqlite3
+import tempfile
+import functools
+import contextlib
+import uuid
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from werkzeug.utils import secure_filename
-from PyPDF2 import PdfReader
-from PyPDF2.errors import PdfReadError
 from io import BytesIO
-from flask_cors import CORS
+from collections import OrderedDict
+
+# Heavy dependencies (OpenAI SDK, psycopg2, PyPDF2, Pillow, flask_cors) are imported
+# where they are first used, so importing this module and booting workers stays cheap.
+logger = logging.getLogger(__name__)
 
 
 # -----------------------------
 # Config
 # -----------------------------
-with open("config.json", "r", encoding="utf-8") as f:
-    cfg = json.load(f)
+CONFIG_PATH = "config.json"
+_CONFIG = None
+_CONFIG_LOCK = threading.Lock()
+
+
+def get_config() -> dict:
+    global _CONFIG
+    if _CONFIG is None:
+        with _CONFIG_LOCK:
+            if _CONFIG is None:
+                with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+                    _CONFIG = json.load(f)
+    return _CONFIG
 
-    import re
 
 MONTHS = {
     "january":"01","february":"02","march":"03","april":"04","may":"05","june":"06",
     "july":"07","august":"08","september":"09","october":"10","november":"11","december":"12"
 }
 
-def month_start_from_text(text: str):
+def find_month_mention(text: str):
+    """Return (month_start 'YYYY-MM-01', matched text) for the first month mentioned, else (None, "")."""
     t = (text or "").lower()
 
     # “december 2024”
@@ -42,16 +68,20 @@ def month_start_from_text(text: str):
         m = re.search(rf"\b{name}\s+(20\d{{2}})\b", t)
         if m:
             yyyy = m.group(1)
-            return f"{yyyy}-{mm}-01"
+            return f"{yyyy}-{mm}-01", m.group(0)
 
     # “2024-12” or “2024/12”
     m = re.search(r"\b(20\d{2})[-/](\d{1,2})\b", t)
     if m:
         yyyy = m.group(1)
         mm = f"{int(m.group(2)):02d}"
-        return f"{yyyy}-{mm}-01"
+        return f"{yyyy}-{mm}-01", m.group(0)
 
-    return None
+    return None, ""
+
+
+def month_start_from_text(text: str):
+    return find_month_mention(text)[0]
 
 
 def _insert_filter_before_tail(sql: str, clause: str) -> str:
@@ -119,26 +149,239 @@ def rewrite_sql(user_text: str, sql: str) -> str:
     return q
 
 SHOW_SQL_PROOF = False
-STREAM_INITIAL_DELAY_SECONDS = 0.1
-STREAM_CHUNK_SIZE = 40
-STREAM_CHUNK_DELAY_SECONDS = 0.06
+STREAM_HEARTBEAT_SECONDS = 15.0  # SSE comment sent when no event went out for this long
+STREAM_REPLAY_MAX_EVENTS = 2000  # per stream; older events can no longer be replayed
+STREAM_REPLAY_MAX_RUNS = 200  # streams kept per worker process for reconnects
+STREAM_REPLAY_TTL_SECONDS = 300  # how long a finished stream stays resumable
+STREAM_MAX_PRODUCERS = 32  # answers generating at once per worker process; more get a 503
+# Stream events are also written here, so a reconnect that lands on another worker can replay them
+STREAM_STORE_PATH = os.path.join(tempfile.gettempdir(), "koko_streams.sqlite3")
+STREAM_STORE_POLL_SECONDS = 0.25  # how often a follower on another worker checks for new events
 MAX_DOC_CHARS = 12000
-MAX_SHEET_CHARS = 12000
 MAX_LINK_CHARS = 12000
 ALLOWED_DOC_EXTENSIONS = {".txt", ".md", ".csv", ".pdf"}
 MEMORY_STORE_PATH = "koko_memories.json"
+SQL_TEMPLATE_STORE_PATH = "koko_sql_templates.json"
+KNOWN_BRANCHES_TTL_SECONDS = 600  # how long the branch list used to validate template slots is reused
+SQL_MAX_PLAN_COST = 500000.0  # EXPLAIN total cost above which query_sql refuses to run
+SQL_MAX_PLAN_ROWS = 5000  # estimated rows above which a LIMIT is added
+SQL_AUTO_LIMIT = 200
+SQL_PLAN_CACHE_SIZE = 256
+AUDIT_LOG_PATH = "koko_audit.jsonl"
+AUDIT_LOG_MAX_BYTES = 10 * 1024 * 1024  # rotate to .1 ... .N past this size
+AUDIT_LOG_BACKUPS = 5
+AUDIT_FLUSH_SECONDS = 1.0
+AUDIT_QUEUE_MAX = 10000
+# Rate limits shared by every worker on the host through a small SQLite file.
+RATE_LIMIT_DB_PATH = os.path.join(tempfile.gettempdir(), "koko_ratelimit.sqlite3")
+RATE_LIMITS = {  # kind -> (tokens refilled per second, bucket size)
+    "chat": (0.5, 10),
+    "snapshot": (0.2, 4),
+    "ingest": (0.1, 5),
+    "batch": (0.02, 2),
+}
+SESSION_MAX_IN_FLIGHT = 2
+IN_FLIGHT_LEASE_SECONDS = 300  # a crashed worker's slots expire after this
+# Session ids are client-supplied, so every client address also gets its own buckets and cap,
+# sized for this many sessions (several staff behind one office NAT).
+RATE_LIMIT_CLIENT_FACTOR = 4
+# Proxies in front of the app that append to X-Forwarded-For (Render: 1). The client address is
+# the entry the outermost of them added; anything left of it is client-supplied.
+TRUSTED_PROXY_HOPS = int(os.environ.get("KOKO_TRUSTED_PROXY_HOPS", 1))
+DB_POOL_MAX_CONNECTIONS = 10  # per worker process and target (primary, each replica)
+DB_CONNECT_TIMEOUT_SECONDS = 5
+DB_REPLICA_MAX_LAG_SECONDS = 30.0  # replicas further behind get no reads (config: PG_REPLICA_MAX_LAG_SECONDS)
+DB_REPLICA_CHECK_SECONDS = 10.0
+SCHEMA_DIGEST_TTL_SECONDS = 600
+MAX_SCHEMA_DIGEST_CHARS = 6000
+WARMUP_MIN_INTERVAL_SECONDS = 60.0  # per session; more /warmup calls inside this window are no-ops
+WARMUP_MAX_PENDING = 4  # warmups queued or running per worker process
+WARMUP_WORKERS = 2
+WARMUP_MAX_SESSIONS = 1000  # dedupe entries kept before expired ones are pruned
+CHAT_BATCH_MAX_QUESTIONS = 50
+CHAT_BATCH_CONCURRENCY = 4
+COLUMNAR_MEASURE_SAMPLE_RATE = 0.1  # share of query_sql results also sized in the old dict format
+SUMMARY_MIN_ROWS = 2  # single-row results are already their own summary
+SUMMARY_MAX_POINTS = 12  # months kept in month-over-month series
+SUMMARY_MAX_RANKED = 10  # branches kept in rankings
+CSV_MAX_ROWS = 200000  # rows kept queryable per table; the profile always covers the whole file
+LOCAL_DB_MAX_SESSIONS = 16  # in-memory SQLite dbs per worker process, least recently used closed first
+LOCAL_DB_MAX_TABLES = 8  # per session
+LOCAL_INDEX_MAX_DISTINCT = 1000  # columns with at most this many distinct values get an index
+LOCAL_SQL_TIMEOUT_SECONDS = 2.0
+CSV_SAMPLE_ROWS = 15
+CSV_DISTINCT_CAP = 1000  # distinct counts above this are reported as "1000+"
+CSV_LIST_VALUES_MAX = 12  # low-cardinality text columns list their values in the profile
+BRANCH_AGG_ENABLED = True
+BRANCH_AGG_TABLE = "branchclients_monthly"
+BRANCH_AGG_REFRESH_SECONDS = 600
+BRANCH_AGG_SHADOW_SAMPLE_RATE = 0.05  # share of routed queries also timed against branchclients
+
+MODEL_PRIMARY = "gpt-5.1"
+MODEL_VISION = "gpt-5.2"
+MODEL_FALLBACK = "gpt-4.1-mini"  # cheaper model used for hedges and when the primary circuit is open
+MODEL_CALL_TIMEOUT_SECONDS = 45.0  # overall deadline per logical call, retries included
+MODEL_MAX_RETRIES = 3
+MODEL_RETRY_BASE_SECONDS = 0.5
+MODEL_RETRY_MAX_SECONDS = 8.0
+MODEL_BREAKER_FAILURES = 5
+MODEL_BREAKER_COOLDOWN_SECONDS = 30.0
+SNAPSHOT_MAX_DIMENSION = 1568  # longest edge sent to the vision model
+SNAPSHOT_FORMAT = "WEBP"
+SNAPSHOT_QUALITY = 80
+SNAPSHOT_CACHE_SIZE = 16
+MAX_SNAPSHOT_BYTES = 20 * 1024 * 1024
+
+# Latency SLO for the primary model; when set, a hedge request goes to MODEL_FALLBACK
+# once the primary has been running this long. Unset = no hedging.
+MODEL_HEDGE_AFTER_SECONDS = float(os.environ["KOKO_HEDGE_AFTER_SECONDS"]) if os.environ.get("KOKO_HEDGE_AFTER_SECONDS") else None
+# Pool for hedged calls: a primary and a hedge for every model call a worker can have in
+# flight (each request thread, times the batch fan-out), so queueing never looks like latency.
+MODEL_HEDGE_WORKERS = 2 * int(os.environ.get("GUNICORN_THREADS", 8)) * CHAT_BATCH_CONCURRENCY
+
+
+def get_db_config(overrides: dict = None) -> dict:
+    cfg = dict(get_config(), **(overrides or {}))
+    return {
+        "host": cfg["PG_HOST"],
+        "port": int(cfg.get("PG_PORT", 5432)),
+        "dbname": cfg["PG_DBNAME"],
+        "user": cfg["PG_USER"],
+        "password": cfg["PG_PASSWORD"],
+        "sslmode": cfg.get("PG_SSLMODE", "require"),
+        "connect_timeout": int(cfg.get("PG_CONNECT_TIMEOUT", DB_CONNECT_TIMEOUT_SECONDS)),
+    }
 
 
-DB_CONFIG = {
-    "host": cfg["PG_HOST"],
-    "port": int(cfg.get("PG_PORT", 5432)),
-    "dbname": cfg["PG_DBNAME"],
-    "user": cfg["PG_USER"],
-    "password": cfg["PG_PASSWORD"],
-    "sslmode": "require",
-}
+def get_db_targets() -> Dict[str, dict]:
+    """
+    Connection settings per target: "primary" plus "replica1", "replica2", ... from the optional
+    PG_REPLICAS config list. Each entry is a libpq DSN string, or a dict of PG_* keys that
+    override the primary's (e.g. {"PG_HOST": "replica.internal"}).
+    """
+    targets = {"primary": get_db_config()}
+    for i, replica in enumerate(get_config().get("PG_REPLICAS") or [], 1):
+        if isinstance(replica, str):
+            targets[f"replica{i}"] = {"dsn": replica, "connect_timeout": DB_CONNECT_TIMEOUT_SECONDS}
+        else:
+            targets[f"replica{i}"] = get_db_config(replica)
+    return targets
+
+
+
+# -----------------------------
+# Metrics (in-process, Prometheus text format at /metrics)
+# -----------------------------
+_METRICS_LOCK = threading.Lock()
+_COUNTERS: Dict[tuple, float] = {}
+_SUMMARIES: Dict[tuple, List[float]] = {}  # key -> [count, sum, max]
+
+
+def _metric_key(metric: str, labels: Dict[str, str]) -> tuple:
+    return (metric, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def metric_inc(metric: str, amount: float = 1, **labels):
+    key = _metric_key(metric, labels)
+    with _METRICS_LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + amount
+
+
+def metric_observe(metric: str, value: float, **labels):
+    key = _metric_key(metric, labels)
+    with _METRICS_LOCK:
+        summary = _SUMMARIES.setdefault(key, [0, 0.0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+        summary[2] = max(summary[2], value)
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_metrics() -> str:
+    lines = []
+    with _METRICS_LOCK:
+        for (metric, labels), value in sorted(_COUNTERS.items()):
+            lines.append(f"koko_{metric}{_format_labels(labels)} {value:g}")
+        for (metric, labels), (count, total, peak) in sorted(_SUMMARIES.items()):
+            lines.append(f"koko_{metric}_count{_format_labels(labels)} {count:g}")
+            lines.append(f"koko_{metric}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"koko_{metric}_max{_format_labels(labels)} {peak:.6f}")
+    return "\n".join(lines) + "\n"
+
+
+# -----------------------------
+# Audit log (append-only JSONL, batched by a background writer)
+# -----------------------------
+# Request threads only enqueue; one writer thread per process batches lines into a single
+# append, so logging never adds latency to a stream. Report: py audit_report.py
+_AUDIT_QUEUE: "queue.Queue[dict]" = queue.Queue(maxsize=AUDIT_QUEUE_MAX)
+_AUDIT_WRITER = {"started": False}
+_AUDIT_WRITER_LOCK = threading.Lock()
+
+
+def audit(event: str, **fields):
+    _ensure_audit_writer()
+    record = {"ts": datetime.utcnow().isoformat() + "Z", "event": event, **fields}
+    try:
+        _AUDIT_QUEUE.put_nowait(record)
+    except queue.Full:
+        metric_inc("audit_dropped_total")
+
+
+def _ensure_audit_writer():
+    if _AUDIT_WRITER["started"]:
+        return
+    with _AUDIT_WRITER_LOCK:
+        if _AUDIT_WRITER["started"]:
+            return
+        _AUDIT_WRITER["started"] = True
+    threading.Thread(target=_audit_writer_loop, name="koko-audit", daemon=True).start()
+
+
+def _rotate_audit_log():
+    for i in range(AUDIT_LOG_BACKUPS - 1, 0, -1):
+        src = f"{AUDIT_LOG_PATH}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{AUDIT_LOG_PATH}.{i + 1}")
+    os.replace(AUDIT_LOG_PATH, f"{AUDIT_LOG_PATH}.1")
 
 
+def _flush_audit(batch: List[dict]):
+    data = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in batch)
+    try:
+        # Every worker appends to the same file: size check, rotation and append happen under
+        # one lock so two workers never rotate at once
+        with _file_lock(AUDIT_LOG_PATH):
+            if os.path.exists(AUDIT_LOG_PATH) and os.path.getsize(AUDIT_LOG_PATH) >= AUDIT_LOG_MAX_BYTES:
+                _rotate_audit_log()
+            with open(AUDIT_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(data)
+        metric_inc("audit_records_written_total", len(batch))
+    except OSError:
+        logger.exception("Audit log write failed")
+        metric_inc("audit_dropped_total", len(batch))
+
+
+def _audit_writer_loop():
+    while True:
+        batch = [_AUDIT_QUEUE.get()]
+        deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_AUDIT_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_audit(batch)
+
 
 # -----------------------------
 # JSON-safe serialization (THE FIX)
@@ -188,6 +431,9 @@ def _extract_text_from_upload(file_storage) -> str:
         return file_storage.read().decode("utf-8", errors="replace")
     
     if ext == ".pdf":
+        from PyPDF2 import PdfReader
+        from PyPDF2.errors import PdfReadError
+
         try:
             try:
                 file_storage.stream.seek(0)
@@ -211,17 +457,45 @@ def _extract_text_from_upload(file_storage) -> str:
 
     raise ValueError("Unsupported file type.")
 
+@contextlib.contextmanager
+def _file_lock(path: str):
+    """Exclusive lock on <path>.lock shared by every worker on the host (no-op where fcntl is missing)."""
+    try:
+        import fcntl
+    except ImportError:  # Windows dev runs are a single process
+        fcntl = None
+    with open(path + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield  # closing the file releases the lock
+
+
+_MEMORY_CACHE = {"stamp": None, "memories": []}  # parsed store, reused until the file changes
+_MEMORY_CACHE_LOCK = threading.Lock()
+
+
 def _load_memories() -> List[Dict[str, str]]:
-    if not os.path.exists(MEMORY_STORE_PATH):
+    try:
+        st = os.stat(MEMORY_STORE_PATH)
+    except OSError:
         return []
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _MEMORY_CACHE_LOCK:
+        if _MEMORY_CACHE["stamp"] == stamp:
+            return list(_MEMORY_CACHE["memories"])
+
+    memories = []
     try:
         with open(MEMORY_STORE_PATH, "r", encoding="utf-8") as f:
             data = json.load(f)
         if isinstance(data, list):
-            return [m for m in data if isinstance(m, dict) and "text" in m]
+            memories = [m for m in data if isinstance(m, dict) and "text" in m]
     except (json.JSONDecodeError, OSError):
         return []
-    return []
+    with _MEMORY_CACHE_LOCK:
+        _MEMORY_CACHE["stamp"] = stamp
+        _MEMORY_CACHE["memories"] = memories
+    return list(memories)
 
 
 def _save_memory(text: str) -> Dict[str, str]:
@@ -307,6 +581,8 @@ def fetch_link_text(link_url: str) -> str:
         data = response.read()
 
     if "application/pdf" in content_type or link_url.lower().endswith(".pdf"):
+        from PyPDF2 import PdfReader
+
         reader = PdfReader(BytesIO(data))
         pages = [(page.extract_text() or "") for page in reader.pages]
         return "\n".join(pages)
@@ -348,12 +624,11 @@ def _extract_signature(text: str) -> str:
     return ""
 
 
-def _strip_email_scaffold(text: str) -> str:
-    if not text:
-        return ""
-    lines = [line.rstrip() for line in text.splitlines()]
-    filtered = []
+def _email_body_lines(lines) -> List[str]:
+    """Lines kept in the email body: scaffold (subject, "Hi ...", sign-off) and blank lines dropped."""
+    kept = []
     for line in lines:
+        line = line.rstrip()
         if re.match(r"(?i)^subject:\s*", line):
             continue
         if re.match(r"(?i)^hi\b", line):
@@ -362,8 +637,15 @@ def _strip_email_scaffold(text: str) -> str:
             continue
         if re.match(r"(?i)^(healthcare plus|koko)$", line.strip()):
             continue
-        filtered.append(line)
-    return "\n".join([line for line in filtered if line.strip()]).strip()
+        if line.strip():
+            kept.append(line)
+    return kept
+
+
+def _strip_email_scaffold(text: str) -> str:
+    if not text:
+        return ""
+    return "\n".join(_email_body_lines(text.splitlines())).strip()
 
 
 def ensure_structured_email(text: str) -> str:
@@ -376,23 +658,743 @@ def ensure_structured_email(text: str) -> str:
     return f"Subject: {subject}\n\n{greeting}\n\n{body}\n\n{closing}"
 
 
+class StreamingEmailFormatter:
+    """
+    ensure_structured_email() over a stream of deltas: feed() returns output as soon as it's
+    final (Subject + greeting once both are known, then body lines as they complete), finish()
+    returns the rest, ending with the sign-off. Only the unfinished last line is held back.
+    The concatenated output is identical to ensure_structured_email(full_text).
+    """
+
+    def __init__(self):
+        self._text = ""  # everything fed so far
+        self._done_upto = 0  # self._text[:_done_upto] ends on "\n": complete lines already processed
+        self._subject = ""
+        self._greeting = ""
+        self._header_sent = False
+        self._pending_body: List[str] = []
+        self._body_started = False
+
+    def _body_out(self, lines: List[str]) -> str:
+        out = []
+        for line in lines:
+            if not self._body_started:
+                out.append(line.lstrip())
+                self._body_started = True
+            else:
+                out.append("\n" + line)
+        return "".join(out)
+
+    def feed(self, delta: str) -> str:
+        self._text += delta or ""
+        cut = self._text.rfind("\n") + 1  # the subject/greeting regexes only know "\n" line ends
+        if cut <= self._done_upto:
+            return ""
+        chunk = self._text[self._done_upto:cut]
+        self._done_upto = cut
+
+        # A match found in complete lines can't change as more text arrives
+        complete = self._text[:cut]
+        if not self._subject:
+            self._subject = _extract_subject(complete)
+        if not self._greeting:
+            self._greeting = _extract_greeting(complete)
+
+        self._pending_body.extend(_email_body_lines(chunk.splitlines()))
+        if not (self._subject and self._greeting):
+            return ""
+        out = ""
+        if not self._header_sent:
+            self._header_sent = True
+            out = f"Subject: {self._subject}\n\n{self._greeting}\n\n"
+        out += self._body_out(self._pending_body)
+        self._pending_body = []
+        return out
+
+    def finish(self) -> str:
+        text = self._text
+        tail = text[self._done_upto:]
+        self._done_upto = len(text)
+        self._pending_body.extend(_email_body_lines(tail.splitlines()))
+
+        out = ""
+        if not self._header_sent:
+            subject = self._subject or _extract_subject(text) or "Email"
+            greeting = self._greeting or _extract_greeting(text) or "Hi there,"
+            out = f"Subject: {subject}\n\n{greeting}\n\n"
+            self._header_sent = True
+        if self._body_started or self._pending_body:
+            out += self._body_out(self._pending_body)
+        else:
+            out += text.strip()
+        self._pending_body = []
+        signature = _extract_signature(text) or "Healthcare Plus"
+        return out + f"\n\nThank you,\n{signature}"
+
+
+
+
+# -----------------------------
+# Screen snapshot helpers
+# -----------------------------
+_SNAPSHOT_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_SNAPSHOT_CACHE_LOCK = threading.Lock()
+
+
+def _read_snapshot_request():
+    """
+    Return (image_bytes, mime, prompt) from either a multipart upload (field "image")
+    or the JSON body with a base64 / data-URL "image". The image is decoded exactly once.
+    """
+    upload = request.files.get("image")
+    if upload is not None:
+        prompt = (request.form.get("prompt") or "").strip()
+        mime = upload.mimetype or "image/png"
+        if "image/" not in mime:
+            raise ValueError("Unsupported image type.")
+        image_bytes = upload.read(MAX_SNAPSHOT_BYTES + 1)
+        if len(image_bytes) > MAX_SNAPSHOT_BYTES:
+            raise ValueError("Image is too large.")
+    else:
+        payload = request.get_json(silent=True) or {}
+        raw_image = (payload.get("image") or "").strip()
+        prompt = (payload.get("prompt") or "").strip()
+        if not raw_image:
+            raise ValueError("No image provided.")
+
+        # Extract base64 + mime from data URL if present
+        mime = "image/png"
+        image_b64 = raw_image
+        if raw_image.startswith("data:"):
+            try:
+                header, image_b64 = raw_image.split(",", 1)  # data:image/png;base64,<...>
+            except ValueError:
+                raise ValueError("Invalid image data URL.")
+            mime = header.split(";")[0].replace("data:", "") or "image/png"
+            if "image/" not in mime:
+                raise ValueError("Unsupported image type.")
+
+        # Validate base64 (and catch padding issues)
+        try:
+            image_bytes = base64.b64decode(image_b64.strip(), validate=True)
+        except Exception:
+            raise ValueError("Invalid base64 image data.")
+
+    if not image_bytes:
+        raise ValueError("No image provided.")
+    return image_bytes, mime, prompt or "Describe what you see on my screen."
+
+
+def _prepare_snapshot_image(image_bytes: bytes, mime: str):
+    """Downscale to SNAPSHOT_MAX_DIMENSION and re-encode as SNAPSHOT_FORMAT. Returns (bytes, mime)."""
+    from PIL import Image
+
+    try:
+        img = Image.open(BytesIO(image_bytes))
+        img.load()
+    except Exception as exc:
+        raise ValueError("Invalid image data.") from exc
+
+    img.thumbnail((SNAPSHOT_MAX_DIMENSION, SNAPSHOT_MAX_DIMENSION))
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+
+    out = BytesIO()
+    img.save(out, format=SNAPSHOT_FORMAT, quality=SNAPSHOT_QUALITY, method=4)
+    encoded = out.getvalue()
+    metric_inc("snapshot_bytes_in_total", len(image_bytes))
+
+    # Re-encoding a tiny, already-compressed image can make it bigger
+    if len(encoded) >= len(image_bytes):
+        metric_inc("snapshot_bytes_out_total", len(image_bytes))
+        return image_bytes, mime
+    metric_inc("snapshot_bytes_out_total", len(encoded))
+    return encoded, f"image/{SNAPSHOT_FORMAT.lower()}"
+
+
+def _snapshot_data_url(image_bytes: bytes, mime: str) -> str:
+    image_bytes, mime = _prepare_snapshot_image(image_bytes, mime)
+    return f"data:{mime};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+
+
+def _snapshot_vision_input(prompt: str, data_url: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": prompt},
+                {"type": "input_image", "image_url": data_url},
+            ],
+        }
+    ]
+
+
+def _record_snapshot_exchange(prompt: str, message: str):
+    """Keep the snapshot Q&A (text only, no image) in the chat so follow-ups can refer to it."""
+    conversation_history.append({"role": "user", "content": f"[Screen snapshot shared] {prompt}"})
+    conversation_history.append({"role": "assistant", "content": message})
+    _trim_history()
+
+
+def _snapshot_cache_get(key: tuple):
+    with _SNAPSHOT_CACHE_LOCK:
+        message = _SNAPSHOT_CACHE.get(key)
+        if message is not None:
+            _SNAPSHOT_CACHE.move_to_end(key)
+    metric_inc("snapshot_cache_total", outcome="hit" if message is not None else "miss")
+    return message
+
+
+def _snapshot_cache_put(key: tuple, message: str):
+    with _SNAPSHOT_CACHE_LOCK:
+        _SNAPSHOT_CACHE[key] = message
+        _SNAPSHOT_CACHE.move_to_end(key)
+        while len(_SNAPSHOT_CACHE) > SNAPSHOT_CACHE_SIZE:
+            _SNAPSHOT_CACHE.popitem(last=False)
 
 
 # -----------------------------
 # DB helper
 # -----------------------------
-def run_sql(query, params=None):
-    conn = psycopg2.connect(**DB_CONFIG)
+# Writes, maintenance and anything consistency-sensitive use the primary. Read-only traffic
+# (model SELECTs, EXPLAINs, schema lookups) passes replica=True and goes to a healthy replica
+# within the lag threshold, falling back to the primary when none is usable.
+_DB_POOLS: Dict[str, object] = {}  # target -> ThreadedConnectionPool
+_DB_POOL_SLOTS: Dict[str, threading.BoundedSemaphore] = {}
+_DB_POOL_LOCK = threading.Lock()
+_REPLICA_HEALTH: Dict[str, dict] = {}  # replica -> {"ok", "lag", "checked_at"}
+_REPLICA_STATE = {"started": False}
+_REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag_seconds;
+"""
+
+
+def _get_db_pool(target: str = "primary"):
+    """Per-process connection pool for a target, created on first query (after gunicorn forks)."""
+    pool = _DB_POOLS.get(target)
+    if pool is None:
+        with _DB_POOL_LOCK:
+            pool = _DB_POOLS.get(target)
+            if pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+
+                pool = ThreadedConnectionPool(1, DB_POOL_MAX_CONNECTIONS, **get_db_targets()[target])
+                # ThreadedConnectionPool raises instead of waiting when exhausted; this makes callers wait.
+                _DB_POOL_SLOTS[target] = threading.BoundedSemaphore(DB_POOL_MAX_CONNECTIONS)
+                _DB_POOLS[target] = pool
+    return pool
+
+
+def _run_on(target: str, query, params, fetch, cursor_factory=None):
+    """Execute on a pooled connection of target and return fetch(cursor); the transaction is always rolled back."""
+    import psycopg2
+
+    pool = _get_db_pool(target)
+    with _DB_POOL_SLOTS[target]:
+        for attempt in range(2):
+            conn = pool.getconn()
+            broken = False
+            try:
+                with conn.cursor(cursor_factory=cursor_factory) as cur:
+                    if isinstance(params, dict):
+                        cur.execute(query, params)
+                    else:
+                        cur.execute(query, tuple(params) if params else None)
+                    result = fetch(cur)
+                conn.rollback()  # read-only: end the transaction before the connection goes back
+                return result
+            except psycopg2.OperationalError:
+                broken = True
+                # A pooled connection the server already closed: retry once on a fresh one
+                if attempt == 0 and conn.closed:
+                    continue
+                raise
+            except Exception:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+                raise
+            finally:
+                pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def check_replicas():
+    """Probe every replica once: reachable and replaying within the lag threshold -> usable."""
+    max_lag = float(get_config().get("PG_REPLICA_MAX_LAG_SECONDS", DB_REPLICA_MAX_LAG_SECONDS))
+    for target in get_db_targets():
+        if target == "primary":
+            continue
+        try:
+            lag = float(_run_on(target, _REPLICA_LAG_SQL, None, lambda cur: cur.fetchone()[0]) or 0)
+        except Exception as exc:
+            logger.warning("Replica %s health check failed: %s", target, exc)
+            lag = None
+        ok = lag is not None and lag <= max_lag
+        was_ok = _REPLICA_HEALTH.get(target, {}).get("ok", True)
+        _REPLICA_HEALTH[target] = {"ok": ok, "lag": lag, "checked_at": time.monotonic()}
+        if lag is not None:
+            metric_observe("db_replica_lag_seconds", lag, target=target)
+        if ok != was_ok:
+            logger.info("Replica %s is now %s (lag=%s)", target, "in rotation" if ok else "out of rotation", lag)
+            metric_inc("db_replica_state_changes_total", target=target, state="up" if ok else "down")
+
+
+def _replica_checker():
+    while True:
+        try:
+            check_replicas()
+        except Exception:
+            logger.exception("Replica health checks failed")
+        time.sleep(DB_REPLICA_CHECK_SECONDS)
+
+
+def _pick_read_target(affinity: str = None) -> str:
+    """A healthy replica (stable per affinity key, e.g. a branch, so its pages stay hot there), else the primary."""
+    replicas = [t for t in get_db_targets() if t != "primary"]
+    if not replicas:
+        return "primary"
+    with _DB_POOL_LOCK:
+        start = not _REPLICA_STATE["started"]
+        _REPLICA_STATE["started"] = True
+    if start:
+        threading.Thread(target=_replica_checker, name="koko-replica-health", daemon=True).start()
+
+    healthy = [t for t in replicas if _REPLICA_HEALTH.get(t, {}).get("ok", True)]
+    if not healthy:
+        return "primary"
+    if affinity:
+        return healthy[zlib.crc32(affinity.encode("utf-8")) % len(healthy)]
+    return random.choice(healthy)
+
+
+def _run_pooled(query, params, fetch, cursor_factory=None, replica: bool = False, affinity: str = None):
+    """Run on the primary, or with replica=True on a read replica with failover to the primary."""
+    import psycopg2
+
+    target = _pick_read_target(affinity) if replica else "primary"
+    metric_inc("db_queries_total", target=target)
+    if target == "primary":
+        return _run_on(target, query, params, fetch, cursor_factory)
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query, tuple(params) if params else None)
-            if cur.description:
-                rows = cur.fetchall()
-                # Convert psycopg2 RealDictRows -> dict, then json-safe
-                return json_safe([dict(r) for r in rows])
-            return []
-    finally:
-        conn.close()
+        return _run_on(target, query, params, fetch, cursor_factory)
+    except psycopg2.extensions.QueryCanceledError:
+        raise  # statement timeout: the query is the problem, don't repeat it on the primary
+    except psycopg2.OperationalError as exc:
+        logger.warning("Replica %s failed, retrying on primary: %s", target, exc)
+        _REPLICA_HEALTH[target] = {"ok": False, "lag": None, "checked_at": time.monotonic()}
+        metric_inc("db_replica_failovers_total", target=target, reason="connection")
+        return _run_on("primary", query, params, fetch, cursor_factory)
+    except psycopg2.errors.UndefinedTable as exc:
+        # The replica hasn't replayed a table the primary just created (branchclients_monthly);
+        # a table that doesn't exist anywhere fails again on the primary with the same error
+        logger.info("Replica %s is missing a table, retrying on primary: %s", target, exc)
+        metric_inc("db_replica_failovers_total", target=target, reason="undefined_table")
+        return _run_on("primary", query, params, fetch, cursor_factory)
+
+
+def run_sql(query, params=None, replica: bool = False, affinity: str = None):
+    from psycopg2.extras import RealDictCursor
+
+    def fetch(cur):
+        rows = cur.fetchall() if cur.description else []
+        # Convert psycopg2 RealDictRows -> dict, then json-safe
+        return json_safe([dict(r) for r in rows])
+
+    return _run_pooled(query, params, fetch, RealDictCursor, replica=replica, affinity=affinity)
+
+
+def run_sql_columnar(query, params=None, replica: bool = False, affinity: str = None,
+                     max_rows: int = None) -> "ColumnarRows":
+    """Like run_sql, but fetches plain tuples straight into a ColumnarRows (no per-row dicts), at most max_rows."""
+    def fetch(cur):
+        if not cur.description:
+            return ColumnarRows([], [], 0)
+        rows = cur.fetchall() if max_rows is None else cur.fetchmany(max_rows)
+        return ColumnarRows.from_rows([d[0] for d in cur.description], rows)
+
+    return _run_pooled(query, params, fetch, replica=replica, affinity=affinity)
+
+
+# -----------------------------
+# Columnar results
+# -----------------------------
+_INT64_MIN, _INT64_MAX = -(2 ** 63), 2 ** 63 - 1
+
+
+def _typed_column(values: list):
+    """array('q') for all-int columns, array('d') for all-numeric ones, the plain list otherwise."""
+    if not values:
+        return values
+    if all(type(v) is int and _INT64_MIN <= v <= _INT64_MAX for v in values):
+        return array("q", values)
+    if all(type(v) in (int, float) for v in values):
+        return array("d", values)
+    return values
+
+
+class ColumnarRows:
+    """
+    Column-oriented SQL result: one value sequence per column instead of one dict per row,
+    so column names aren't repeated per row in memory or in what the model sees.
+    """
+    __slots__ = ("columns", "values", "row_count")
+
+    def __init__(self, columns: List[str], values: list, row_count: int):
+        self.columns = columns
+        self.values = values
+        self.row_count = row_count
+
+    @classmethod
+    def from_rows(cls, columns: List[str], rows: list) -> "ColumnarRows":
+        values = [_typed_column([json_safe(r[i]) for r in rows]) for i in range(len(columns))]
+        return cls(columns, values, len(rows))
+
+    @classmethod
+    def from_records(cls, records: List[dict]) -> "ColumnarRows":
+        columns = list(records[0].keys()) if records else []
+        return cls.from_rows(columns, [tuple(r.get(c) for c in columns) for r in records])
+
+    def rows(self, limit: int = None) -> List[list]:
+        n = self.row_count if limit is None else min(limit, self.row_count)
+        return [[col[i] for col in self.values] for i in range(n)]
+
+    def to_records(self, limit: int = None) -> List[dict]:
+        return [dict(zip(self.columns, row)) for row in self.rows(limit)]
+
+    def to_payload(self) -> dict:
+        """CSV-style JSON: {"columns": [...], "rows": [[...], ...], "row_count": n}."""
+        return {"columns": self.columns, "rows": self.rows(), "row_count": self.row_count}
+
+
+def _approx_tokens(text: str) -> int:
+    # Word/punctuation pieces track BPE token counts of JSON closely enough for comparisons
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def _measure_columnar_savings(result: "ColumnarRows"):
+    columnar = json.dumps(result.to_payload())
+    as_dicts = json.dumps({"rows": result.to_records()})
+    metric_inc("sql_payload_bytes_total", len(as_dicts.encode("utf-8")), format="dict")
+    metric_inc("sql_payload_bytes_total", len(columnar.encode("utf-8")), format="columnar")
+    metric_inc("sql_payload_tokens_estimated_total", _approx_tokens(as_dicts), format="dict")
+    metric_inc("sql_payload_tokens_estimated_total", _approx_tokens(columnar), format="columnar")
+
+
+# -----------------------------
+# CSV ingestion
+# -----------------------------
+# .csv uploads and Google Sheets exports are parsed as a stream in one pass: column types are
+# inferred and profiled (counts, distinct, min/max, sums) over the whole file, the typed rows
+# go to the session's local SQLite db, and the prompt only gets the profile plus a few sample rows.
+_CSV_NUMBER_RE = re.compile(r"^[+-]?\$?(\d{1,3}(,\d{3})+|\d+)?(\.\d+)?([eE][+-]?\d+)?$")
+_CSV_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?)?$")
+_CSV_NULLS = {"", "null", "none", "n/a", "na", "nan", "-"}
+
+
+def _csv_number(v: str):
+    """int/float for "1234", "-3.5", "$1,234.50"; None for anything else."""
+    if not any(ch.isdigit() for ch in v) or not _CSV_NUMBER_RE.match(v):
+        return None
+    s = v.replace("$", "").replace(",", "")
+    if "." in s or "e" in s or "E" in s:
+        return float(s)
+    return int(s)
+
+
+def _csv_column_names(header: list) -> List[str]:
+    names = []
+    for i, raw in enumerate(header):
+        name = re.sub(r"[^a-z0-9]+", "_", (raw or "").strip().lower()).strip("_") or f"col_{i + 1}"
+        if name[0].isdigit():
+            name = f"c_{name}"
+        base, n = name, 2
+        while name in names:
+            name, n = f"{base}_{n}", n + 1
+        names.append(name)
+    return names
+
+
+class _ColumnProfile:
+    """Running type and statistics for one CSV column, updated one value at a time."""
+    __slots__ = ("name", "kind", "count", "nulls", "distinct", "num_min", "num_max", "num_sum", "text_min", "text_max")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.kind = None  # int -> float -> text, date -> text; never widens back
+        self.count = 0
+        self.nulls = 0
+        self.distinct = set()  # dropped (None) once it passes CSV_DISTINCT_CAP
+        self.num_min = self.num_max = self.text_min = self.text_max = None
+        self.num_sum = 0
+
+    def add(self, v: str):
+        if v.lower() in _CSV_NULLS:
+            self.nulls += 1
+            return
+        self.count += 1
+        if self.distinct is not None:
+            self.distinct.add(v)
+            if len(self.distinct) > CSV_DISTINCT_CAP:
+                self.distinct = None
+        if self.text_min is None or v < self.text_min:
+            self.text_min = v
+        if self.text_max is None or v > self.text_max:
+            self.text_max = v
+
+        if self.kind == "text":
+            return
+        num = _csv_number(v)
+        if num is not None:
+            kind = "int" if type(num) is int else "float"
+            if self.num_min is None or num < self.num_min:
+                self.num_min = num
+            if self.num_max is None or num > self.num_max:
+                self.num_max = num
+            self.num_sum += num
+        else:
+            kind = "date" if _CSV_DATE_RE.match(v) else "text"
+
+        if self.kind is None or self.kind == kind:
+            self.kind = kind
+        elif {self.kind, kind} == {"int", "float"}:
+            self.kind = "float"
+        else:
+            self.kind = "text"
+
+    def convert(self, v):
+        if v is None or v.lower() in _CSV_NULLS:
+            return None
+        if self.kind == "int":
+            return _csv_number(v)
+        if self.kind == "float":
+            return float(_csv_number(v))
+        return v
+
+    def to_dict(self) -> dict:
+        out = {
+            "name": self.name,
+            "type": self.kind or "empty",
+            "count": self.count,
+            "nulls": self.nulls,
+            "distinct": len(self.distinct) if self.distinct is not None else f"{CSV_DISTINCT_CAP}+",
+        }
+        if self.kind in ("int", "float"):
+            out.update(min=self.num_min, max=self.num_max, sum=round(self.num_sum, 4),
+                       mean=round(self.num_sum / self.count, 4) if self.count else None)
+        elif self.kind in ("date", "text"):
+            out.update(min=self.text_min, max=self.text_max)
+            if self.distinct is not None and len(self.distinct) <= CSV_LIST_VALUES_MAX:
+                out["values"] = sorted(self.distinct)
+        return out
+
+
+class CsvTable:
+    """Profile of an ingested CSV; the rows themselves live in the session's local SQLite db."""
+    __slots__ = ("name", "source", "columns", "kinds", "profile", "total_rows", "loaded_rows", "sample")
+
+    def __init__(self, name, source, columns, kinds, profile, total_rows, loaded_rows, sample):
+        self.name = name
+        self.source = source
+        self.columns = columns
+        self.kinds = kinds
+        self.profile = profile
+        self.total_rows = total_rows
+        self.loaded_rows = loaded_rows
+        self.sample = sample
+
+    @property
+    def truncated(self) -> bool:
+        return self.loaded_rows < self.total_rows
+
+
+def ingest_csv(session_id: str, name: str, source: str, stream) -> CsvTable:
+    """Parse a binary CSV stream (upload or HTTP response) in one pass and load it into the session's local db."""
+    reader = csv.reader(codecs.iterdecode(stream, "utf-8-sig", errors="replace"))
+    header = next(reader, None)
+    if not header or not any(h.strip() for h in header):
+        raise ValueError("CSV has no header row.")
+
+    columns = _csv_column_names(header)
+    profiles = [_ColumnProfile(c) for c in columns]
+    raw_columns = [[] for _ in columns]
+    sample = [header]
+    total = 0
+    width = len(columns)
+    for row in reader:
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        total += 1
+        if len(sample) <= CSV_SAMPLE_ROWS:
+            sample.append(row)
+        keep = total <= CSV_MAX_ROWS
+        for i in range(width):
+            v = row[i].strip() if i < len(row) else ""
+            profiles[i].add(v)
+            if keep:
+                raw_columns[i].append(v)
+
+    table = CsvTable(
+        name=_csv_column_names([name])[0],
+        source=source,
+        columns=columns,
+        kinds={p.name: p.kind or "empty" for p in profiles},
+        profile=[p.to_dict() for p in profiles],
+        total_rows=total,
+        loaded_rows=min(total, CSV_MAX_ROWS),
+        sample=sample,
+    )
+    values = [[p.convert(v) for v in raw] for p, raw in zip(profiles, raw_columns)]
+    del raw_columns
+    _load_local_table(session_id, table, values)
+    metric_inc("csv_ingested_rows_total", total)
+    return table
+
+
+def csv_table_prompt(table: CsvTable) -> str:
+    """Profile + sample text added to the conversation in place of the raw CSV."""
+    lines = [
+        f"Table loaded: {table.name} (from {table.source}), {table.total_rows} rows x {len(table.columns)} columns. "
+        f"The full table is in the local SQLite db: use query_sql with target \"local\" and FROM {table.name} "
+        "for filters, totals and lookups.",
+        "Columns:",
+    ]
+    for p in table.profile:
+        stats = f"{p['count']} values, {p['nulls']} empty, {p['distinct']} distinct"
+        if p["type"] in ("int", "float"):
+            stats += f"; min {p['min']}, max {p['max']}, sum {p['sum']}, mean {p['mean']}"
+        elif "values" in p:
+            stats += f"; values: {', '.join(p['values'])}"
+        elif p["type"] == "date" and p["count"]:
+            stats += f"; range {p['min']} .. {p['max']}"
+        lines.append(f"- {p['name']} ({p['type']}): {stats}")
+    if table.truncated:
+        lines.append(f"[Only the first {table.loaded_rows} rows are queryable; the profile covers all rows]")
+
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows(table.sample)
+    lines.append(f"Sample (first {len(table.sample) - 1} rows, original headers):")
+    lines.append(buf.getvalue().rstrip())
+    return "\n".join(lines)
+
+
+# -----------------------------
+# Local SQL (per-session SQLite)
+# -----------------------------
+# Ingested CSVs and sheets are loaded into an in-memory SQLite db per session and queried through
+# query_sql(target="local"), read-only and time-boxed, so a 100k-row sheet costs one local query.
+_SQLITE_TYPES = {"int": "INTEGER", "float": "REAL"}
+_LOCAL_SQL_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+class _LocalDb:
+    __slots__ = ("conn", "lock", "tables")
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = threading.Lock()
+        self.tables: "OrderedDict[str, CsvTable]" = OrderedDict()
+
+
+_LOCAL_DBS: "OrderedDict[str, _LocalDb]" = OrderedDict()  # session -> db, LRU
+_LOCAL_DBS_LOCK = threading.Lock()
+
+
+def _local_db(session_id: str, create: bool = False):
+    evicted = []
+    with _LOCAL_DBS_LOCK:
+        db = _LOCAL_DBS.get(session_id)
+        if db is None and create:
+            db = _LOCAL_DBS[session_id] = _LocalDb()
+            while len(_LOCAL_DBS) > LOCAL_DB_MAX_SESSIONS:
+                evicted.append(_LOCAL_DBS.popitem(last=False)[1])
+        if db is not None:
+            _LOCAL_DBS.move_to_end(session_id)
+    # Outside the registry lock: wait for a query still running on an evicted db
+    for old in evicted:
+        with old.lock:
+            old.conn.close()
+    return db
+
+
+def _load_local_table(session_id: str, table: CsvTable, values: list):
+    """(Re)create the table in the session db, bulk insert, and index the low-cardinality columns."""
+    db = _local_db(session_id, create=True)
+    cols = ", ".join(f'"{c}" {_SQLITE_TYPES.get(table.kinds[c], "TEXT")}' for c in table.columns)
+    placeholders = ", ".join("?" for _ in table.columns)
+    with db.lock:
+        conn = db.conn
+        with conn:
+            conn.execute(f'DROP TABLE IF EXISTS "{table.name}"')
+            conn.execute(f'CREATE TABLE "{table.name}" ({cols})')
+            conn.executemany(f'INSERT INTO "{table.name}" VALUES ({placeholders})', zip(*values))
+            for p in table.profile:
+                if isinstance(p["distinct"], int) and 1 < p["distinct"] <= min(LOCAL_INDEX_MAX_DISTINCT, p["count"] // 2):
+                    conn.execute(f'CREATE INDEX "ix_{table.name}_{p["name"]}" ON "{table.name}" ("{p["name"]}")')
+        conn.execute("ANALYZE")
+        db.tables.pop(table.name, None)
+        db.tables[table.name] = table
+        while len(db.tables) > LOCAL_DB_MAX_TABLES:
+            old, _ = db.tables.popitem(last=False)
+            with conn:
+                conn.execute(f'DROP TABLE IF EXISTS "{old}"')
+
+
+def _local_sql_authorizer(action, *_):
+    return sqlite3.SQLITE_OK if action in _LOCAL_SQL_ALLOWED_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def run_local_sql(session_id: str, sql: str) -> dict:
+    """
+    query_sql(target="local"): run a SELECT against the session's ingested tables. Same result shape
+    as run_model_sql, and the same contract for bad SQL: {"error", "feedback"} instead of raising.
+    """
+    db = _local_db(session_id)
+    if db is None or not db.tables:
+        return {"error": "No CSV or Google Sheet has been loaded in this conversation.",
+                "feedback": "Use target 'postgres' for the database."}
+
+    deadline = time.monotonic() + LOCAL_SQL_TIMEOUT_SECONDS
+    started = time.monotonic()
+    with db.lock:
+        conn = db.conn
+        conn.set_authorizer(_local_sql_authorizer)
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        try:
+            cur = conn.execute(sql)
+            columns = [d[0] for d in cur.description or []]
+            rows = cur.fetchmany(SQL_AUTO_LIMIT + 1)
+        except sqlite3.Error as exc:
+            tables = "; ".join(f"{t.name}({', '.join(t.columns)})" for t in db.tables.values())
+            if time.monotonic() > deadline:
+                metric_inc("sql_guard_total", outcome="rejected")
+                return {"error": f"Query rejected: ran past {LOCAL_SQL_TIMEOUT_SECONDS:.0f}s.",
+                        "feedback": "Filter first and aggregate with COUNT/SUM and GROUP BY; avoid cross joins."}
+            metric_inc("sql_guard_total", outcome="invalid")
+            return {"error": f"SQL error: {exc}", "feedback": f"SQLite dialect. Loaded tables: {tables}"}
+        finally:
+            conn.set_authorizer(None)
+            conn.set_progress_handler(None, 0)
+    metric_observe("sql_query_seconds", time.monotonic() - started, target="local")
+
+    limited = len(rows) > SQL_AUTO_LIMIT
+    result_rows = ColumnarRows.from_rows(columns, rows[:SQL_AUTO_LIMIT])
+    metric_observe("sql_rows_returned", result_rows.row_count)
+    result = result_rows.to_payload()
+    summary = summarize_result(result_rows, limited)
+    if summary:
+        result["summary"] = summary
+    if limited:
+        metric_inc("sql_guard_total", outcome="limited")
+        result["note"] = (
+            f"More than {SQL_AUTO_LIMIT} rows matched, so only the first {SQL_AUTO_LIMIT} were returned. "
+            "Use COUNT/SUM/GROUP BY if you need totals across all rows."
+        )
+    return result
 
 
 # -----------------------------
@@ -411,7 +1413,7 @@ def get_schema(mode, table=None, column=None, limit=50):
             FROM information_schema.tables
             WHERE table_schema='public'
             ORDER BY table_name;
-        """)
+        """, replica=True)
 
     if mode == "columns":
         if table:
@@ -421,14 +1423,14 @@ def get_schema(mode, table=None, column=None, limit=50):
                 WHERE table_schema='public'
                 AND table_name = %s
                 ORDER BY ordinal_position;
-            """, [table])
+            """, [table], replica=True)
         else:
             return run_sql("""
                 SELECT table_name, column_name, data_type
                 FROM information_schema.columns
                 WHERE table_schema='public'
                 ORDER BY table_name, ordinal_position;
-            """)
+            """, replica=True)
 
 
     if mode == "distinct" and table and column:
@@ -437,108 +1439,1297 @@ def get_schema(mode, table=None, column=None, limit=50):
             return [{"error": "Unsafe table/column name."}]
 
         q = f'SELECT DISTINCT "{column}" AS value FROM "{table}" WHERE "{column}" IS NOT NULL LIMIT {int(limit)};'
-        return run_sql(q)
+        return run_sql(q, replica=True)
 
     return [{"error": "Invalid schema request."}]
 
 
-# -----------------------------
-# OpenAI Tools
-# -----------------------------
-SQL_TOOL = {
-    "type": "function",
-    "name": "query_sql",
-    "description": "Run a READ-ONLY SQL query (SELECT) on the Postgres database and return rows as JSON.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "query": {"type": "string", "description": "A SQL SELECT statement. Avoid placeholders like %s or $1."}
-        },
-        "required": ["query"]
-    }
-}
+_SCHEMA_DIGEST = {"text": "", "built_at": 0.0}
+_SCHEMA_DIGEST_LOCK = threading.Lock()
 
-SCHEMA_TOOL = {
-    "type": "function",
-    "name": "get_schema",
-    "description": "Get database schema: tables and columns in public schema (and optionally sample distinct values for a column).",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "mode": {"type": "string", "enum": ["tables", "columns", "distinct"]},
-            "table": {"type": "string"},
-            "column": {"type": "string"},
-            "limit": {"type": "integer", "default": 50}
-        },
-        "required": ["mode"]
-    }
-}
+
+def get_schema_digest(force: bool = False) -> str:
+    """Compact "table: column type, ..." listing of the public schema, cached for SCHEMA_DIGEST_TTL_SECONDS."""
+    with _SCHEMA_DIGEST_LOCK:
+        if not force and _SCHEMA_DIGEST["text"] and time.monotonic() - _SCHEMA_DIGEST["built_at"] < SCHEMA_DIGEST_TTL_SECONDS:
+            return _SCHEMA_DIGEST["text"]
+
+    tables: Dict[str, List[str]] = {}
+    for row in get_schema("columns"):
+        tables.setdefault(row["table_name"], []).append(f"{row['column_name']} {row['data_type']}")
+    lines = [f"- {t}: {', '.join(cols)}" for t, cols in tables.items()]
+    text = "Database schema (public), use these exact names:\n" + "\n".join(lines)
+    if len(text) > MAX_SCHEMA_DIGEST_CHARS:
+        text = text[:MAX_SCHEMA_DIGEST_CHARS].rsplit("\n", 1)[0] + "\n[Schema truncated; use get_schema for more]"
+
+    with _SCHEMA_DIGEST_LOCK:
+        _SCHEMA_DIGEST["text"] = text
+        _SCHEMA_DIGEST["built_at"] = time.monotonic()
+    return text
 
 
 # -----------------------------
-# App
+# Result summaries (NumPy)
 # -----------------------------
-app = Flask(__name__)
-client = OpenAI()
+# Totals, means, month-over-month deltas and branch rankings computed server-side and added
+# to the query_sql output, so the model quotes numbers instead of adding up rows itself.
+_ID_COLUMN_RE = re.compile(r"(?i)^(id|.*_id)$")
+# Integer date parts (2024, 12, Q3): labels, not quantities, so never summed
+_DATE_PART_COLUMN_RE = re.compile(r"(?i)^(.*_)?(year|yr|month|month_num|quarter|qtr|week|day|dow|hour)$")
+_MONTH_COLUMN_RE = re.compile(r"(?i)^(month|.*_month|period|date)$")
+_BRANCH_COLUMN_RE = re.compile(r"(?i)^(branch|branch_key|branch_name)$")
 
-def _normalize_origin(value: str) -> str:
-    return value.rstrip("/") if value else value
 
+def _r2(x) -> float:
+    return round(float(x), 2)
 
-def _cors_allowed_origins():
-    return [
-        "https://bakckend-koko.onrender.com",
-        "http://localhost:5173",
-    ]
 
+def _month_key(v) -> str:
+    # Month numbers (EXTRACT/date_part come back as float or Decimal) are zero-padded ints so
+    # they sort in calendar order; dates and "YYYY-MM" strings keep their year-month prefix
+    if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) and float(v).is_integer():
+        return f"{int(v):02d}"
+    return str(v)[:7]
 
-def _cors_allowed_origin():
-    origin = request.headers.get("Origin")
-    if not origin:
-        return ""
-    allowed_list = _cors_allowed_origins()
-    if "*" in allowed_list or origin in allowed_list:
-        return origin
-    return ""
 
-CORS(
-    app,
-    origins=[
-        "https://backkend-koko-frontend.onrender.com",
-        "https://bakckend-koko-frontend.onrender.com",
-        "http://localhost:5173",
-    ],
-)
+def summarize_result(result: "ColumnarRows", limited: bool = False):
+    """
+    Compact summary of a ColumnarRows result, or None (too few rows, no numeric columns, no
+    NumPy, or limited: the rows were cut off at SQL_AUTO_LIMIT, so any totals would be wrong).
+    """
+    if limited or result.row_count < SUMMARY_MIN_ROWS:
+        return None
+    try:
+        import numpy as np
+    except ImportError:
+        return None
 
-@app.after_request
-def add_cors_headers(response):
-    allowed_origin = _cors_allowed_origin()
-    if allowed_origin:
-        response.headers["Access-Control-Allow-Origin"] = allowed_origin
-        response.headers["Vary"] = "Origin"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    return response
+    numeric = {}
+    for name, col in zip(result.columns, result.values):
+        if isinstance(col, array) and not _ID_COLUMN_RE.match(name) and not _DATE_PART_COLUMN_RE.match(name):
+            dtype = np.int64 if col.typecode == "q" else np.float64
+            numeric[name] = np.frombuffer(col, dtype=dtype).astype(np.float64)
+    if not numeric:
+        return None
 
+    summary = {
+        "totals": {
+            name: {"sum": _r2(v.sum()), "mean": _r2(v.mean()), "min": _r2(v.min()), "max": _r2(v.max())}
+            for name, v in numeric.items()
+        }
+    }
 
+    def grouped(col_re, key_fn):
+        idx = next((i for i, c in enumerate(result.columns) if col_re.match(c) and c not in numeric), None)
+        if idx is None:
+            return None, None
+        keys = np.array([key_fn(v) for v in result.values[idx]])
+        labels, inverse = np.unique(keys, return_inverse=True)
+        if len(labels) < 2:
+            return None, None
+        return labels, {name: np.bincount(inverse, weights=v, minlength=len(labels)) for name, v in numeric.items()}
+
+    months, month_totals = grouped(_MONTH_COLUMN_RE, _month_key)
+    if months is not None:
+        months = months[-SUMMARY_MAX_POINTS:]
+        by_month = {"months": months.tolist()}
+        for name, totals in month_totals.items():
+            totals = totals[-SUMMARY_MAX_POINTS:]
+            delta = np.diff(totals)
+            prev = totals[:-1]
+            pct = np.divide(delta * 100, prev, out=np.full_like(delta, np.nan), where=prev != 0)
+            by_month[name] = {
+                "totals": [_r2(x) for x in totals],
+                "mom_delta": [_r2(x) for x in delta],
+                "mom_pct": [None if np.isnan(x) else _r2(x) for x in pct],
+            }
+        summary["by_month"] = by_month
+
+    branches, branch_totals = grouped(_BRANCH_COLUMN_RE, lambda v: str(v).strip())
+    if branches is not None:
+        summary["branch_ranking"] = {
+            name: [[str(branches[i]), _r2(totals[i])] for i in np.argsort(-totals, kind="stable")[:SUMMARY_MAX_RANKED]]
+            for name, totals in branch_totals.items()
+        }
+
+    return summary
+
+
+def chart_from_summary(summary: dict):
+    """Chart-ready series for the frontend: a line over months, else a bar over branches."""
+    if not summary:
+        return None
+    by_month = summary.get("by_month")
+    if by_month:
+        series = [{"name": k, "values": v["totals"]} for k, v in by_month.items() if k != "months"]
+        return {"type": "line", "x": by_month["months"], "series": series}
+    ranking = summary.get("branch_ranking")
+    if ranking:
+        name, ranked = next(iter(ranking.items()))
+        return {"type": "bar", "x": [b for b, _ in ranked], "series": [{"name": name, "values": [v for _, v in ranked]}]}
+    return None
 
-SYSTEM_PROMPT = """
 
-Your name is Koko 🐨
+# -----------------------------
+# Branch aggregates (branchclients per branch_key + month)
+# -----------------------------
+# Side table with one row per UPPER(TRIM(branch)) + month: row_count plus sum_<col> for every
+# numeric column. Single-row COUNT(*)/SUM(col) queries filtered by branch and month are
+# routed here instead of scanning branchclients with a non-indexable UPPER(TRIM(branch)).
+_BRANCH_AGG_STATE = {"ready": False, "sum_columns": {}, "started": False, "refreshed_at": None}
+_BRANCH_AGG_LOCK = threading.Lock()
+_BRANCH_AGG_ADVISORY_KEY = 0x6B6F6B6F  # one refresher at a time across workers
+_NUMERIC_TYPES = ("smallint", "integer", "bigint", "numeric", "real", "double precision")
+
+_ALIAS = r"""(?:\s+(?:as\s+)?(?P<alias>\w+|"[^"]+"))?"""
+_AGG_SELECT_ITEM_RE = re.compile(
+    r"""(?is)^\s*(?:(?P<count>count\(\s*(?:\*|1)\s*\))|sum\(\s*"?(?P<sum>\w+)"?\s*\))""" + _ALIAS + r"\s*$"
+)
+_AGG_QUERY_RE = re.compile(
+    r"""(?is)^\s*select\s+(?P<select>.+?)\s+from\s+(?:public\.)?"?branchclients"?(?:\s+(?:as\s+)?(?P<table_alias>\w+))?"""
+    r"""\s+where\s+(?P<where>.+?)\s*;?\s*$"""
+)
+_AGG_BRANCH_FILTER_RE = re.compile(
+    r"""(?is)^\s*UPPER\(TRIM\((?:\w+\.)?"?branch"?\)\)\s*=\s*(?P<value>UPPER\(TRIM\((?:'[^']*'|%\(branch\)s)\)\))\s*$"""
+)
+_AGG_MONTH_FILTER_RE = re.compile(
+    r"""(?is)^\s*(?:\w+\.)?"?month"?\s*=\s*(?P<value>date_trunc\('month',\s*DATE\s*'[\d-]+'\)::date|DATE\s*'[\d-]+'|%\(month\)s::date)\s*$"""
+)
 
-You are a koala-themed AI assistant for Healthcare Plus.
 
-You are a senior technical and operations assistant — calm, precise, and dependable.
+def _run_maintenance(fn):
+    """Run fn(cursor) in one committed transaction (run_sql is read-only and never commits)."""
+    import psycopg2
 
-1. Personality & Tone
+    conn = psycopg2.connect(**get_db_config())
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                return fn(cur)
+    finally:
+        conn.close()
 
-Sound natural, friendly, and professional
 
-Use light, purposeful emojis to add warmth and clarity
+def refresh_branch_aggregates():
+    """
+    Create the side table if needed, then rebuild only the months whose fingerprint differs
+    from branchclients (plus the latest month, which is the one still changing). The
+    fingerprint is the row count, a hash sum of the branch keys and every column sum, so
+    corrections to older months are picked up, not just inserts and deletes.
+    """
+    def _refresh(cur):
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (_BRANCH_AGG_ADVISORY_KEY,))
+        if not cur.fetchone()[0]:
+            return None  # another worker is refreshing
+
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema='public' AND table_name='branchclients' AND data_type = ANY(%s)
+            ORDER BY ordinal_position;
+        """, (list(_NUMERIC_TYPES),))
+        numeric_cols = [r[0] for r in cur.fetchall() if is_safe_identifier(r[0])]
+
+        def select_for(cols):
+            sums = "".join(f', SUM("{c}") AS "sum_{c}"' for c in cols)
+            return f"SELECT UPPER(TRIM(branch)) AS branch_key, month, COUNT(*) AS row_count{sums} FROM branchclients"
+
+        cur.execute("SELECT to_regclass(%s)", (f"public.{BRANCH_AGG_TABLE}",))
+        if cur.fetchone()[0] is None:
+            cur.execute(f"CREATE TABLE {BRANCH_AGG_TABLE} AS {select_for(numeric_cols)} WHERE month IS NOT NULL GROUP BY 1, 2 WITH NO DATA")
+            cur.execute(f"CREATE UNIQUE INDEX ON {BRANCH_AGG_TABLE} (branch_key, month)")
+            cur.execute(f"CREATE INDEX ON {BRANCH_AGG_TABLE} (month)")
+
+        # Columns added to branchclients after the side table was created are not aggregated
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema='public' AND table_name = %s;
+        """, (BRANCH_AGG_TABLE,))
+        aggregated = {r[0] for r in cur.fetchall()}
+        numeric_cols = [c for c in numeric_cols if f"sum_{c}" in aggregated]
+        select = select_for(numeric_cols)
+
+        # Float sums depend on addition order, so they are compared rounded
+        base_fp = "".join(f', ROUND(SUM("{c}")::numeric, 4) AS "s_{c}"' for c in numeric_cols)
+        agg_fp = "".join(f', ROUND(SUM("sum_{c}")::numeric, 4) AS "s_{c}"' for c in numeric_cols)
+        fp_cols = ["c", "h"] + [f'"s_{c}"' for c in numeric_cols]
+        cur.execute(f"""
+            SELECT month FROM (
+                SELECT month, COUNT(*) AS c, SUM(hashtext(UPPER(TRIM(branch)))::bigint) AS h{base_fp}
+                FROM branchclients WHERE month IS NOT NULL GROUP BY month
+            ) b
+            FULL JOIN (
+                SELECT month, SUM(row_count) AS c, SUM(hashtext(branch_key)::bigint * row_count) AS h{agg_fp}
+                FROM {BRANCH_AGG_TABLE} GROUP BY month
+            ) a USING (month)
+            WHERE ({", ".join("b." + c for c in fp_cols)}) IS DISTINCT FROM ({", ".join("a." + c for c in fp_cols)})
+               OR month = (SELECT MAX(month) FROM branchclients);
+        """)
+        dirty = [r[0] for r in cur.fetchall()]
+        if dirty:
+            cur.execute(f"DELETE FROM {BRANCH_AGG_TABLE} WHERE month = ANY(%s)", (dirty,))
+            columns = ", ".join(["branch_key", "month", "row_count"] + [f'"sum_{c}"' for c in numeric_cols])
+            cur.execute(f"INSERT INTO {BRANCH_AGG_TABLE} ({columns}) {select} WHERE month = ANY(%s) GROUP BY 1, 2", (dirty,))
+        return len(dirty)
+
+    started = time.monotonic()
+    refreshed = _run_maintenance(_refresh)
+    if refreshed is not None:
+        metric_inc("branch_aggregate_refreshes_total")
+        metric_inc("branch_aggregate_months_refreshed_total", refreshed)
+        metric_observe("branch_aggregate_refresh_seconds", time.monotonic() - started)
+    _load_branch_aggregate_columns()
+
+
+def _load_branch_aggregate_columns():
+    rows = run_sql("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema='public' AND table_name = %s;
+    """, [BRANCH_AGG_TABLE])
+    cols = {r["column_name"] for r in rows}
+    with _BRANCH_AGG_LOCK:
+        # sum_<col> already has the type SUM(<col>) returns on branchclients; keep it when re-summing
+        _BRANCH_AGG_STATE["sum_columns"] = {
+            r["column_name"][4:]: r["data_type"] for r in rows if r["column_name"].startswith("sum_")
+        }
+        _BRANCH_AGG_STATE["ready"] = {"branch_key", "month", "row_count"} <= cols
+        _BRANCH_AGG_STATE["refreshed_at"] = datetime.utcnow().isoformat() + "Z"
+
+
+def _branch_aggregate_refresher():
+    while True:
+        try:
+            refresh_branch_aggregates()
+        except Exception:
+            logger.exception("Branch aggregate refresh failed; routing stays on last known state")
+            metric_inc("branch_aggregate_refresh_errors_total")
+        time.sleep(BRANCH_AGG_REFRESH_SECONDS)
+
+
+def _ensure_branch_aggregates():
+    """Start this worker's refresher thread on first use (after fork, never at import)."""
+    with _BRANCH_AGG_LOCK:
+        if _BRANCH_AGG_STATE["started"] or not BRANCH_AGG_ENABLED:
+            return
+        _BRANCH_AGG_STATE["started"] = True
+    threading.Thread(target=_branch_aggregate_refresher, name="koko-branch-agg", daemon=True).start()
+
+
+def route_branch_aggregates(sql: str):
+    """Return an equivalent query on the aggregate table for eligible rewritten SQL, else None."""
+    with _BRANCH_AGG_LOCK:
+        if not _BRANCH_AGG_STATE["ready"]:
+            return None
+        sum_columns = dict(_BRANCH_AGG_STATE["sum_columns"])
+
+    m = _AGG_QUERY_RE.match(sql or "")
+    if not m or re.search(r"(?is)\b(join|group\s+by|order\s+by|having|limit|offset|union|or|not)\b", m.group("where")):
+        return None
 
-Avoid slang, overuse of emojis, or playful distractions
+    select_items = []
+    for item in m.group("select").split(","):
+        im = _AGG_SELECT_ITEM_RE.match(item)
+        if not im:
+            return None
+        if im.group("count"):
+            expr, default_alias = "COALESCE(SUM(row_count), 0)::bigint", "count"
+        elif im.group("sum") in sum_columns:
+            expr, default_alias = f'SUM("sum_{im.group("sum")}")::{sum_columns[im.group("sum")]}', "sum"
+        else:
+            return None
+        select_items.append(f"{expr} AS {im.group('alias') or default_alias}")
+
+    filters = []
+    has_month = False
+    for part in re.split(r"(?i)\s+and\s+", m.group("where")):
+        bm = _AGG_BRANCH_FILTER_RE.match(part)
+        mm = _AGG_MONTH_FILTER_RE.match(part)
+        if bm:
+            filters.append(f"branch_key = {bm.group('value')}")
+        elif mm:
+            filters.append(f"month = {mm.group('value')}")
+            has_month = True
+        else:
+            return None
+    if not has_month:
+        return None  # rows with a NULL month are not aggregated
 
-Be concise, confident, and helpful
+    return f"SELECT {', '.join(select_items)} FROM {BRANCH_AGG_TABLE} WHERE {' AND '.join(filters)}"
+
+
+# -----------------------------
+# SQL cost guard and execution
+# -----------------------------
+# Model-written SQL is EXPLAINed first (plans cached per normalized statement), then run on a
+# replica, through the branch aggregates when eligible.
+_PLAN_CACHE: "OrderedDict[str, dict]" = OrderedDict()  # normalized SQL + params -> EXPLAIN cost and rows
+_PLAN_CACHE_LOCK = threading.Lock()
+_SQL_QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def _normalize_sql_for_plan(sql: str, params=None) -> str:
+    # Only case and spacing outside quotes are folded: literals, LIMITs and params change the
+    # estimate, so two statements share a plan only when they'd get the same one
+    parts = _SQL_QUOTED_RE.split((sql or "").strip().rstrip(";").rstrip())
+    key = "".join(p if i % 2 else re.sub(r"\s+", " ", p.lower()) for i, p in enumerate(parts))
+    return key if params is None else key + " -- " + json.dumps(params, default=str)
+
+
+def _append_limit(sql: str, limit: int) -> str:
+    return sql.strip().rstrip(";").rstrip() + f" LIMIT {int(limit)}"
+
+
+def guard_sql(sql: str, params=None) -> dict:
+    """
+    EXPLAIN the query (plan cached per normalized SQL and params) and decide: run as-is, run with an
+    added LIMIT (too many estimated rows), or reject (estimated cost too high).
+    Raises on SQL the planner can't parse.
+    """
+    key = _normalize_sql_for_plan(sql, params)
+    with _PLAN_CACHE_LOCK:
+        plan = _PLAN_CACHE.get(key)
+        if plan is not None:
+            _PLAN_CACHE.move_to_end(key)
+    metric_inc("sql_plan_cache_total", outcome="hit" if plan is not None else "miss")
+
+    if plan is None:
+        explained = run_sql("EXPLAIN (FORMAT JSON) " + sql.strip().rstrip(";"), params, replica=True)
+        top = explained[0]["QUERY PLAN"][0]["Plan"]
+        plan = {"cost": float(top.get("Total Cost", 0)), "rows": int(top.get("Plan Rows", 0))}
+        with _PLAN_CACHE_LOCK:
+            _PLAN_CACHE[key] = plan
+            while len(_PLAN_CACHE) > SQL_PLAN_CACHE_SIZE:
+                _PLAN_CACHE.popitem(last=False)
+
+    verdict = {"error": None, "feedback": None, "limited": False, "cost": plan["cost"], "plan_rows": plan["rows"]}
+
+    if plan["cost"] > SQL_MAX_PLAN_COST:
+        metric_inc("sql_guard_total", outcome="rejected")
+        verdict["error"] = f"Query rejected: estimated cost {plan['cost']:.0f} is above the limit of {SQL_MAX_PLAN_COST:.0f}."
+        verdict["feedback"] = (
+            "Write a cheaper query: filter on branch and month, aggregate with COUNT/SUM and GROUP BY "
+            "instead of returning raw rows, and make sure every JOIN has an ON condition."
+        )
+        return verdict
+
+    has_limit = re.search(r"(?is)\blimit\s+\d+\s*(offset\s+\d+\s*)?;?\s*$", sql)
+    if plan["rows"] > SQL_MAX_PLAN_ROWS and not has_limit:
+        metric_inc("sql_guard_total", outcome="limited")
+        verdict["limited"] = True
+        verdict["feedback"] = (
+            f"About {plan['rows']} rows estimated, so only the first {SQL_AUTO_LIMIT} were returned. "
+            "Use COUNT/SUM/GROUP BY if you need totals across all rows."
+        )
+        return verdict
+
+    metric_inc("sql_guard_total", outcome="allowed")
+    return verdict
+
+
+def _shadow_compare(base_sql: str, params, routed_rows, max_rows: int = None):
+    started = time.monotonic()
+    try:
+        base_rows = run_sql_columnar(base_sql, params, replica=True, max_rows=max_rows).rows()
+    except Exception:
+        logger.exception("Branch aggregate shadow query failed")
+        return
+    metric_observe("sql_query_seconds", time.monotonic() - started, target="branchclients_shadow")
+    if json.dumps(base_rows, sort_keys=True) != json.dumps(routed_rows, sort_keys=True):
+        metric_inc("branch_aggregate_shadow_total", outcome="mismatch")
+        logger.info("Branch aggregate mismatch for %s: base=%s aggregate=%s", base_sql, base_rows, routed_rows)
+    else:
+        metric_inc("branch_aggregate_shadow_total", outcome="match")
+
+
+def _branch_affinity(sql: str):
+    """Branch a query is about, if any: its reads go to the same replica every time."""
+    match = _BRANCH_LITERAL_RE.search(sql) or re.search(r"(?i)\bbranch\w*\s*=\s*'([^']+)'", sql)
+    return match.group(1).strip().upper() if match else None
+
+
+def _execute_routed(sql: str, params=None, max_rows: int = None):
+    """run_sql on a read replica that routes to branch aggregates when eligible and times it."""
+    routed = route_branch_aggregates(sql)
+    affinity = _branch_affinity(sql)
+    started = time.monotonic()
+    if routed is None:
+        result = run_sql_columnar(sql, params, replica=True, affinity=affinity, max_rows=max_rows)
+        metric_observe("sql_query_seconds", time.monotonic() - started, target="branchclients" if "branchclients" in sql.lower() else "other")
+        return result
+
+    result = run_sql_columnar(routed, params, replica=True, affinity=affinity, max_rows=max_rows)
+    metric_observe("sql_query_seconds", time.monotonic() - started, target="branch_aggregate")
+    metric_inc("branch_aggregate_routed_total")
+    if random.random() < BRANCH_AGG_SHADOW_SAMPLE_RATE:
+        threading.Thread(target=_shadow_compare, args=(sql, params, result.rows(), max_rows), daemon=True).start()
+    return result
+
+
+def run_model_sql(sql: str, params=None) -> dict:
+    """
+    Execute model-written / template SQL behind the EXPLAIN cost guard and return the
+    query_sql tool result: {"columns": [...], "rows": [[...]], "row_count": n} (plus "note" if a
+    LIMIT was added or the rows were capped), or
+    {"error": ..., "feedback": ...} the model can use to write a cheaper query.
+    """
+    import psycopg2
+
+    _ensure_branch_aggregates()
+    to_run = route_branch_aggregates(sql) or sql
+    try:
+        verdict = guard_sql(to_run, params)
+    except Exception as exc:
+        if isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            raise  # connection trouble, not the model's SQL
+        metric_inc("sql_guard_total", outcome="invalid")
+        return {"error": f"SQL error: {str(exc).strip()}", "feedback": "Fix the SQL; check table/column names with get_schema."}
+
+    if verdict["error"]:
+        return {"error": verdict["error"], "feedback": verdict["feedback"]}
+
+    if verdict["limited"]:
+        sql = _append_limit(sql, SQL_AUTO_LIMIT)
+    # The estimate can be far off (or the model's own LIMIT huge): never fetch more than the cap
+    rows = _execute_routed(sql, params, max_rows=SQL_AUTO_LIMIT + 1)
+    if rows.row_count > SQL_AUTO_LIMIT:
+        metric_inc("sql_guard_total", outcome="limited")
+        rows = ColumnarRows.from_rows(rows.columns, rows.rows(SQL_AUTO_LIMIT))
+        verdict["limited"] = True
+        verdict["feedback"] = (
+            f"More than {SQL_AUTO_LIMIT} rows matched, so only the first {SQL_AUTO_LIMIT} were returned. "
+            "Use COUNT/SUM/GROUP BY if you need totals across all rows."
+        )
+
+    estimated = verdict["plan_rows"]
+    metric_observe("sql_plan_rows_estimated", estimated)
+    metric_observe("sql_rows_returned", rows.row_count)
+    logger.info("SQL rows estimated=%s actual=%s cost=%.1f: %s", estimated, rows.row_count, verdict["cost"], sql)
+    if random.random() < COLUMNAR_MEASURE_SAMPLE_RATE:
+        _measure_columnar_savings(rows)
+
+    result = rows.to_payload()
+    summary = summarize_result(rows, verdict["limited"])
+    if summary:
+        result["summary"] = summary
+    if verdict["limited"]:
+        result["note"] = verdict["feedback"]
+    return result
+
+
+# -----------------------------
+# SQL template cache
+# -----------------------------
+# Learns "how many active clients in Aurora for December 2024" -> SQL with %(branch)s /
+# %(month)s placeholders from successful query_sql runs, so the same question shape can
+# skip schema discovery and tool rounds.
+_SQL_TEMPLATES = {"stamp": None, "store": None}  # {"templates": {shape: {...}}, "branches": [...]}, reread when the file changes
+_SQL_TEMPLATES_LOCK = threading.Lock()
+_KNOWN_BRANCHES = {"names": {}, "loaded_at": None}
+_KNOWN_BRANCHES_LOCK = threading.Lock()
+
+_BRANCH_LITERAL_RE = re.compile(r"UPPER\(TRIM\('([^']+)'\)\)")
+_DATE_LITERAL_RE = re.compile(r"'(\d{4}-\d{2}-\d{2})'")
+_MONTH_DATE_RE = re.compile(r"(?i)date_trunc\('month',\s*DATE\s*'(\d{4}-\d{2})-\d{2}'\)::date|DATE\s*'(\d{4}-\d{2})-01'")
+MIN_TEMPLATE_QUESTION_WORDS = 4
+
+
+def _sql_template_stamp():
+    try:
+        st = os.stat(SQL_TEMPLATE_STORE_PATH)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _load_sql_templates() -> dict:
+    """Call with _SQL_TEMPLATES_LOCK held. Rereads the file when another worker has written to it."""
+    stamp = _sql_template_stamp()
+    if _SQL_TEMPLATES["store"] is not None and _SQL_TEMPLATES["stamp"] == stamp:
+        return _SQL_TEMPLATES["store"]
+    data = {}
+    if stamp is not None:
+        try:
+            with open(SQL_TEMPLATE_STORE_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            data = {}
+    if not isinstance(data, dict):
+        data = {}
+    _SQL_TEMPLATES["stamp"] = stamp
+    _SQL_TEMPLATES["store"] = {
+        "templates": data.get("templates") if isinstance(data.get("templates"), dict) else {},
+        "branches": [b for b in data.get("branches", []) if isinstance(b, str)],
+    }
+    return _SQL_TEMPLATES["store"]
+
+
+def _normalize_branch(name: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", (name or "").lower()).split())
+
+
+def known_branches() -> Dict[str, str]:
+    """Normalized -> stored name of every branch in branchclients, cached for KNOWN_BRANCHES_TTL_SECONDS."""
+    with _KNOWN_BRANCHES_LOCK:
+        loaded_at = _KNOWN_BRANCHES["loaded_at"]
+        if loaded_at is not None and time.monotonic() - loaded_at < KNOWN_BRANCHES_TTL_SECONDS:
+            return _KNOWN_BRANCHES["names"]
+        aggregates_ready = _BRANCH_AGG_STATE["ready"]
+
+    if aggregates_ready:
+        query = f"SELECT DISTINCT branch_key AS branch FROM {BRANCH_AGG_TABLE};"
+    else:
+        query = "SELECT DISTINCT UPPER(TRIM(branch)) AS branch FROM branchclients WHERE branch IS NOT NULL;"
+    try:
+        rows = run_sql(query, replica=True)
+    except Exception:
+        logger.exception("Could not load branch names; templates will not bind unseen branches")
+        return {}
+    names = {_normalize_branch(r["branch"]): r["branch"] for r in rows if _normalize_branch(r["branch"])}
+    with _KNOWN_BRANCHES_LOCK:
+        _KNOWN_BRANCHES["names"] = names
+        _KNOWN_BRANCHES["loaded_at"] = time.monotonic()
+    return names
+
+
+def _question_shape(text: str, branch_text: str = "", month_text: str = "") -> str:
+    t = (text or "").lower()
+    if month_text:
+        t = t.replace(month_text.lower(), " <month> ")
+    if branch_text:
+        t = re.sub(rf"\b{re.escape(branch_text.lower())}\b", " <branch> ", t)
+    t = re.sub(r"[^a-z0-9<>]+", " ", t)
+    return " ".join(t.split())
+
+
+def _find_known_branch(text: str, branches: List[str]) -> str:
+    t = (text or "").lower()
+    found = [b for b in branches if re.search(rf"\b{re.escape(b.lower())}\b", t)]
+    return max(found, key=len) if found else ""
+
+
+def learn_sql_template(user_text: str, sql: str):
+    """
+    Record a template from a successful, rewritten query_sql statement. Only learned when
+    every branch/month literal in the SQL corresponds to one mentioned in the question,
+    so no stale literal can survive in the template.
+    """
+    if len((user_text or "").split()) < MIN_TEMPLATE_QUESTION_WORDS:
+        return
+    month_start, month_text = find_month_mention(user_text)
+    template = sql.replace("%", "%%")
+    params = []
+
+    branch_literals = set(_BRANCH_LITERAL_RE.findall(template))
+    branch = ""
+    if branch_literals:
+        if len(branch_literals) != 1:
+            return
+        branch = branch_literals.pop()
+        if not re.search(rf"\b{re.escape(branch.lower())}\b", user_text.lower()):
+            return
+        template = template.replace(f"UPPER(TRIM('{branch}'))", "UPPER(TRIM(%(branch)s))")
+        if branch.lower() in template.lower():
+            return
+        params.append("branch")
+
+    if _DATE_LITERAL_RE.search(template):
+        if not month_start:
+            return
+        for m in _MONTH_DATE_RE.finditer(template):
+            if (m.group(1) or m.group(2)) != month_start[:7]:
+                return
+        template = _MONTH_DATE_RE.sub("%(month)s::date", template)
+        if _DATE_LITERAL_RE.search(template) or month_start[:7] in template:
+            return
+        params.append("month")
+
+    if not params:
+        return
+
+    shape = _question_shape(user_text, branch, month_text if "month" in params else "")
+    # Merge into the file as it is now, so templates other workers learned are kept
+    with _SQL_TEMPLATES_LOCK, _file_lock(SQL_TEMPLATE_STORE_PATH):
+        store = _load_sql_templates()
+        if store["templates"].get(shape, {}).get("sql") == template:
+            return
+        store["templates"][shape] = {
+            "sql": template,
+            "params": params,
+            "learned_at": datetime.utcnow().isoformat() + "Z",
+        }
+        if branch and branch not in store["branches"]:
+            store["branches"].append(branch)
+        try:
+            tmp_path = SQL_TEMPLATE_STORE_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(store, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, SQL_TEMPLATE_STORE_PATH)
+            _SQL_TEMPLATES["stamp"] = _sql_template_stamp()
+        except OSError:
+            logger.warning("Could not persist SQL templates to %s", SQL_TEMPLATE_STORE_PATH)
+    metric_inc("sql_templates_learned_total")
+
+
+def _match_unseen_branch(user_text: str, month_text: str, templates: dict, branches: Dict[str, str]):
+    """
+    Branch not seen before: use each <branch> shape as a pattern and capture the slot. The
+    capture must be a real branch ("in total for ..." is not), else the tool loop answers.
+    """
+    for m in (month_text, ""):
+        shape = _question_shape(user_text, "", m)
+        for template_shape, entry in templates.items():
+            if "<branch>" not in template_shape:
+                continue
+            pattern = re.escape(template_shape).replace("<branch>", r"([a-z0-9]+(?: [a-z0-9]+){0,3})")
+            match = re.fullmatch(pattern, shape)
+            if not match:
+                continue
+            if match.group(1) in branches:
+                return branches[match.group(1)], entry
+            metric_inc("sql_template_lookups_total", outcome="unknown_branch")
+    return "", None
+
+
+def match_sql_template(user_text: str):
+    """Return (sql, params) for a learned template matching this question, else None."""
+    with _SQL_TEMPLATES_LOCK:
+        store = _load_sql_templates()
+        branch = _find_known_branch(user_text, store["branches"])
+        month_start, month_text = find_month_mention(user_text)
+        entry = None
+        for b, m in ((branch, month_text), (branch, ""), ("", month_text)):
+            entry = store["templates"].get(_question_shape(user_text, b, m))
+            if entry:
+                break
+        templates = dict(store["templates"]) if not entry else {}
+
+    # Outside the lock: the branch list may need a query
+    if not entry and any("<branch>" in shape for shape in templates):
+        b, entry = _match_unseen_branch(user_text, month_text, templates, known_branches())
+
+    if not entry:
+        metric_inc("sql_template_lookups_total", outcome="miss")
+        return None
+
+    params = {}
+    if "branch" in entry["params"]:
+        params["branch"] = b
+    if "month" in entry["params"]:
+        params["month"] = month_start
+    if any(not v for v in params.values()):
+        metric_inc("sql_template_lookups_total", outcome="miss")
+        return None
+    metric_inc("sql_template_lookups_total", outcome="hit")
+    return entry["sql"], params
+
+
+# -----------------------------
+# OpenAI Tools
+# -----------------------------
+SQL_TOOL = {
+    "type": "function",
+    "name": "query_sql",
+    "description": "Run a READ-ONLY SQL query (SELECT) on the Postgres database, or with target 'local' on CSV/Google Sheet tables loaded in this conversation. Returns {columns, rows, row_count} where each row is a list of values in column order, plus a precomputed summary (totals, month-over-month deltas, branch rankings) for multi-row numeric results: quote those numbers instead of recomputing. Very expensive queries are rejected with feedback, and very large results are capped with a note.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "query": {"type": "string", "description": "A SQL SELECT statement. Avoid placeholders like %s or $1."},
+            "target": {
+                "type": "string",
+                "enum": ["postgres", "local"],
+                "description": "'local' queries CSV uploads / Google Sheets loaded in this conversation (SQLite dialect, table names from the 'Table loaded' message). Default 'postgres'."
+            }
+        },
+        "required": ["query"]
+    }
+}
+
+SCHEMA_TOOL = {
+    "type": "function",
+    "name": "get_schema",
+    "description": "Get database schema: tables and columns in public schema (and optionally sample distinct values for a column).",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "mode": {"type": "string", "enum": ["tables", "columns", "distinct"]},
+            "table": {"type": "string"},
+            "column": {"type": "string"},
+            "limit": {"type": "integer", "default": 50}
+        },
+        "required": ["mode"]
+    }
+}
+
+
+
+# -----------------------------
+# Tool loop controller
+# -----------------------------
+CHAT_MAX_MODEL_CALLS = 6  # the last allowed call is always a forced answer (tool_choice="none")
+CHAT_LATENCY_BUDGET_SECONDS = 30.0
+CHAT_TOKEN_BUDGET = 40000
+FORCED_ANSWER_PROMPT = "Answer ONLY using the SQL results above. If a count exists in the rows, use that number exactly."
+
+_QUANTITY_QUESTION_RE = re.compile(r"(?i)\b(how\s+many|how\s+much|count|number\s+of|total|sum|average|avg)\b")
+
+
+def _sql_answers_question(user_text: str, rows) -> bool:
+    """
+    True when the rows are a single aggregate row and the user asked a quantity question,
+    i.e. the model already has everything it needs to answer.
+    """
+    if not _QUANTITY_QUESTION_RE.search(user_text or ""):
+        return False
+    if not isinstance(rows, list) or len(rows) != 1:
+        return False
+    row = rows[0]
+    if isinstance(row, dict):
+        if "error" in row:
+            return False
+        row = list(row.values())
+    return any(isinstance(v, (int, float)) and not isinstance(v, bool) for v in row)
+
+
+class ToolLoopController:
+    """Decides when chat_stream stops offering tools, and memoizes identical tool calls per request."""
+
+    def __init__(self, user_message: str):
+        self.user_message = user_message
+        self.started = time.monotonic()
+        self.rounds = 0
+        self.tokens = 0
+        self.stop_reason = None
+        self._memo: Dict[str, dict] = {}  # key -> {"output": str, "audit": fields of the original call}
+
+    def record_round(self, resp):
+        self.rounds += 1
+        usage = getattr(resp, "usage", None)
+        self.tokens += int(getattr(usage, "total_tokens", 0) or 0)
+
+    def force_stop(self, reason: str):
+        self.stop_reason = self.stop_reason or reason
+
+    def note_sql_rows(self, rows):
+        if _sql_answers_question(self.user_message, rows):
+            self.force_stop("answered")
+
+    def should_stop(self) -> bool:
+        if self.stop_reason:
+            return True
+        if self.rounds >= CHAT_MAX_MODEL_CALLS - 1:
+            self.stop_reason = "max_rounds"
+        elif time.monotonic() - self.started >= CHAT_LATENCY_BUDGET_SECONDS:
+            self.stop_reason = "latency_budget"
+        elif self.tokens >= CHAT_TOKEN_BUDGET:
+            self.stop_reason = "token_budget"
+        return bool(self.stop_reason)
+
+    @staticmethod
+    def _memo_key(name: str, args: dict) -> str:
+        return name + ":" + json.dumps(args, sort_keys=True, default=str)
+
+    def memo_get(self, name: str, args: dict):
+        entry = self._memo.get(self._memo_key(name, args))
+        if entry is not None:
+            metric_inc("chat_tool_memo_hits_total", tool=name)
+        return entry
+
+    def memo_put(self, name: str, args: dict, output: str, audit_fields: dict):
+        self._memo[self._memo_key(name, args)] = {"output": output, "audit": audit_fields}
+
+    def finish(self):
+        reason = self.stop_reason or "model_answered"
+        metric_inc("chat_tool_loop_stops_total", reason=reason)
+        metric_observe("chat_rounds_per_answer", self.rounds)
+        metric_observe("chat_tokens_per_answer", self.tokens)
+        metric_observe("chat_tool_loop_seconds", time.monotonic() - self.started)
+
+
+# -----------------------------
+# App
+# -----------------------------
+bp = Blueprint("koko", __name__)
+_client = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """
+    OpenAI client, built on first use. Never called from create_app(): with gunicorn
+    preload_app the HTTP connection pool must be created after the worker forks.
+    """
+    global _client
+    if _client is None:
+        with _CLIENT_LOCK:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(max_retries=0)  # retries are handled by create_response()
+    return _client
+
+
+# -----------------------------
+# Model client (deadlines, retry, circuit breaker, hedging)
+# -----------------------------
+class ModelUnavailableError(RuntimeError):
+    """Raised when a model call can't be served: circuit open, retries or deadline exhausted."""
+
+
+class _CircuitBreaker:
+    def __init__(self, failure_threshold: int, cooldown_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        with self._lock:
+            if self._state == "closed":
+                return False
+            if self._state == "open":
+                return time.monotonic() - self._opened_at < self.cooldown_seconds
+            return True  # half-open: a probe is already in flight
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == "closed":
+                return True
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+                self._state = "half_open"  # this caller is the probe
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+
+_BREAKERS: Dict[str, _CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+_MODEL_EXECUTOR = ThreadPoolExecutor(max_workers=MODEL_HEDGE_WORKERS, thread_name_prefix="koko-model")
+
+
+def _breaker_for(model: str) -> _CircuitBreaker:
+    with _BREAKERS_LOCK:
+        if model not in _BREAKERS:
+            _BREAKERS[model] = _CircuitBreaker(MODEL_BREAKER_FAILURES, MODEL_BREAKER_COOLDOWN_SECONDS)
+        return _BREAKERS[model]
+
+
+def _model_error_kind(exc: Exception) -> str:
+    """Classify an OpenAI SDK error: 'rate_limited', 'server_error', 'timeout' are retryable."""
+    status = getattr(exc, "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if isinstance(status, int) and status >= 500:
+        return "server_error"
+    if type(exc).__name__ in {"APITimeoutError", "APIConnectionError"}:
+        return "timeout"
+    return "client_error"
+
+
+def _retry_after_seconds(exc: Exception) -> float:
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def cached_input_tokens(usage) -> int:
+    details = getattr(usage, "input_tokens_details", None)
+    return int(getattr(details, "cached_tokens", 0) or 0)
+
+
+def _record_prompt_cache(model: str, usage):
+    """Input tokens vs. the share served from the provider's prompt cache."""
+    input_tokens = int(getattr(usage, "input_tokens", 0) or 0)
+    if not input_tokens:
+        return
+    cached = cached_input_tokens(usage)
+    metric_inc("model_input_tokens_total", input_tokens, model=model)
+    metric_inc("model_cached_input_tokens_total", cached, model=model)
+    metric_observe("model_prompt_cache_ratio", cached / input_tokens, model=model)
+
+
+def _call_with_retry(model: str, deadline: float, kwargs: dict, cancel: threading.Event = None):
+    breaker = _breaker_for(model)
+    attempt = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            metric_inc("model_calls_total", model=model, outcome="cancelled")
+            raise ModelUnavailableError(f"{model} call cancelled.")
+        if not breaker.allow():
+            metric_inc("model_calls_total", model=model, outcome="breaker_open")
+            raise ModelUnavailableError(f"{model} is temporarily unavailable (circuit open).")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            metric_inc("model_calls_total", model=model, outcome="deadline_exceeded")
+            raise ModelUnavailableError(f"{model} call exceeded its deadline.")
+
+        started = time.monotonic()
+        try:
+            resp = get_client().responses.create(model=model, timeout=remaining, **kwargs)
+        except Exception as exc:
+            kind = _model_error_kind(exc)
+            metric_inc("model_calls_total", model=model, outcome=kind)
+            if kind == "client_error":
+                breaker.record_success()  # the service answered; the request itself was bad
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if attempt > MODEL_MAX_RETRIES:
+                raise ModelUnavailableError(f"{model} failed after {attempt} attempts: {exc}") from exc
+            # Full jitter, but never sooner than the server asked us to wait
+            delay = random.uniform(0, min(MODEL_RETRY_MAX_SECONDS, MODEL_RETRY_BASE_SECONDS * (2 ** (attempt - 1))))
+            delay = max(delay, min(_retry_after_seconds(exc), MODEL_RETRY_MAX_SECONDS))
+            if time.monotonic() + delay >= deadline:
+                metric_inc("model_calls_total", model=model, outcome="deadline_exceeded")
+                raise ModelUnavailableError(f"{model} call exceeded its deadline.") from exc
+            metric_inc("model_retries_total", model=model, reason=kind)
+            if cancel is not None:
+                cancel.wait(delay)  # the top of the loop gives up once cancelled
+            else:
+                time.sleep(delay)
+            continue
+
+        breaker.record_success()
+        metric_inc("model_calls_total", model=model, outcome="success")
+        metric_observe("model_latency_seconds", time.monotonic() - started, model=model)
+        _record_prompt_cache(model, getattr(resp, "usage", None))
+        return resp
+
+
+def _hedged_call(model: str, fallback_model: str, deadline: float, kwargs: dict):
+    cancel = threading.Event()
+    primary = _MODEL_EXECUTOR.submit(_call_with_retry, model, deadline, kwargs, cancel)
+    done, _ = wait([primary], timeout=MODEL_HEDGE_AFTER_SECONDS)
+    if done:
+        exc = primary.exception()
+        if exc is None:
+            return primary.result()
+        # Failed before the hedge delay: fall back right away, as the unhedged path does
+        if not isinstance(exc, ModelUnavailableError) or time.monotonic() >= deadline:
+            raise exc
+        metric_inc("model_fallbacks_total", model=fallback_model, reason="primary_failed")
+        return _call_with_retry(fallback_model, deadline, kwargs)
+
+    metric_inc("model_hedges_total", model=fallback_model, outcome="started")
+    hedge = _MODEL_EXECUTOR.submit(_call_with_retry, fallback_model, deadline, kwargs, cancel)
+    pending = {primary, hedge}
+    first_error = None
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    resp = fut.result()
+                except Exception as exc:
+                    first_error = first_error or exc
+                    continue
+                metric_inc("model_hedges_total", model=fallback_model, outcome="hedge_won" if fut is hedge else "primary_won")
+                return resp
+        raise first_error
+    finally:
+        # The loser finishes the attempt already in flight but makes no further retries
+        cancel.set()
+
+
+def create_response(model: str = MODEL_PRIMARY, fallback_model: str = MODEL_FALLBACK,
+                    timeout: float = MODEL_CALL_TIMEOUT_SECONDS, hedge: bool = True, **kwargs):
+    """
+    Drop-in for client.responses.create with a per-call deadline, jittered exponential
+    retry on 429/5xx/timeouts, a per-model circuit breaker and an optional hedge to
+    fallback_model once the primary runs past MODEL_HEDGE_AFTER_SECONDS.
+    """
+    deadline = time.monotonic() + timeout
+    can_fall_back = bool(fallback_model) and fallback_model != model
+
+    if can_fall_back and _breaker_for(model).is_open():
+        metric_inc("model_fallbacks_total", model=fallback_model, reason="breaker_open")
+        return _call_with_retry(fallback_model, deadline, kwargs)
+
+    if can_fall_back and hedge and MODEL_HEDGE_AFTER_SECONDS:
+        return _hedged_call(model, fallback_model, deadline, kwargs)
+
+    try:
+        return _call_with_retry(model, deadline, kwargs)
+    except ModelUnavailableError:
+        if not can_fall_back or time.monotonic() >= deadline:
+            raise
+        metric_inc("model_fallbacks_total", model=fallback_model, reason="primary_failed")
+        return _call_with_retry(fallback_model, deadline, kwargs)
+
+
+def stream_response(model: str = MODEL_PRIMARY, fallback_model: str = MODEL_FALLBACK,
+                    timeout: float = MODEL_CALL_TIMEOUT_SECONDS, **kwargs):
+    """
+    Yield output-text deltas from a streamed response, then return the completed response
+    (tool calls, usage), or None if the stream ended without one. Retry, breaker and fallback
+    only apply to opening the stream; once deltas have gone out a failure is raised as-is.
+    """
+    completed = None
+    deadline = time.monotonic() + timeout
+    kwargs = dict(kwargs, stream=True)
+    try:
+        stream = _call_with_retry(model, deadline, kwargs)
+    except ModelUnavailableError:
+        if not fallback_model or fallback_model == model or time.monotonic() >= deadline:
+            raise
+        metric_inc("model_fallbacks_total", model=fallback_model, reason="primary_failed")
+        stream = _call_with_retry(fallback_model, deadline, kwargs)
+
+    try:
+        for event in stream:
+            event_type = getattr(event, "type", None)
+            if event_type == "response.output_text.delta":
+                yield event.delta
+            elif event_type == "response.completed":
+                completed = getattr(event, "response", None)
+                _record_prompt_cache(getattr(completed, "model", None) or model, getattr(completed, "usage", None))
+            elif event_type in ("response.failed", "error"):
+                error = getattr(getattr(event, "response", None), "error", None) or event
+                metric_inc("model_calls_total", model=model, outcome="stream_failed")
+                raise ModelUnavailableError(f"{model} stream failed: {getattr(error, 'message', None) or event_type}")
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    return completed
+
+
+def stream_response_text(model: str = MODEL_PRIMARY, fallback_model: str = MODEL_FALLBACK,
+                         timeout: float = MODEL_CALL_TIMEOUT_SECONDS, **kwargs):
+    """Yield output-text deltas from a streamed response (stream_response without the result)."""
+    yield from stream_response(model, fallback_model, timeout, **kwargs)
+
+
+def _session_id() -> str:
+    """Client-supplied session id (X-Session-Id header or "session_id" field), else the client address."""
+    sid = request.headers.get("X-Session-Id")
+    if not sid and request.is_json:
+        sid = (request.get_json(silent=True) or {}).get("session_id")
+    if not sid:
+        sid = request.form.get("session_id") if request.form else None
+    if not sid:
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        sid = forwarded.split(",")[0].strip() or request.remote_addr or "anonymous"
+    return str(sid)[:128]
+
+
+# -----------------------------
+# Rate limiting (token buckets + in-flight caps per client and session, shared across workers)
+# -----------------------------
+_RATE_LIMIT_LOCAL = threading.local()
+
+
+def _rate_limit_db() -> sqlite3.Connection:
+    conn = getattr(_RATE_LIMIT_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(RATE_LIMIT_DB_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS inflight (id TEXT PRIMARY KEY, session TEXT, expires REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS inflight_session ON inflight (session)")
+        _RATE_LIMIT_LOCAL.conn = conn
+    return conn
+
+
+def _take_token(key: str, rate: float, burst: float) -> float:
+    """Take one token from the bucket. Returns 0 if allowed, else seconds until a token is available."""
+    conn = _rate_limit_db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 86400,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return 0.0 if allowed else (1 - tokens) / rate
+
+
+def _acquire_slot(session: str, cap: int = SESSION_MAX_IN_FLIGHT):
+    """Reserve an in-flight slot for the key; returns a slot id, or None when at the cap."""
+    conn = _rate_limit_db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM inflight WHERE expires < ?", (now,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM inflight WHERE session = ?", (session,)).fetchone()
+        slot_id = None
+        if count < cap:
+            slot_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO inflight (id, session, expires) VALUES (?, ?, ?)",
+                         (slot_id, session, now + IN_FLIGHT_LEASE_SECONDS))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return slot_id
+
+
+def _release_slot(slot_id: str):
+    try:
+        _rate_limit_db().execute("DELETE FROM inflight WHERE id = ?", (slot_id,))
+    except sqlite3.Error:
+        logger.exception("Failed to release in-flight slot; it expires with its lease")
+
+
+def _too_many_requests(message: str, retry_after: float):
+    response = jsonify({"error": message})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
+def client_address(remote_addr: str, forwarded_for: str = "") -> str:
+    """The caller's address as seen by our outermost trusted proxy, else the socket peer."""
+    hops = [h.strip() for h in (forwarded_for or "").split(",") if h.strip()]
+    if TRUSTED_PROXY_HOPS and len(hops) >= TRUSTED_PROXY_HOPS:
+        return hops[-TRUSTED_PROXY_HOPS]
+    return remote_addr or "unknown"
+
+
+def acquire_rate_limit(kind: str, session: str, client: str):
+    """
+    Token buckets, then in-flight caps, per client address and per session. Returns
+    (error, retry_after, slots): error is None when the request may run, and slots must go
+    to release_rate_limit() once its response is finished. Fails open if the store is down.
+    """
+    rate, burst = RATE_LIMITS[kind]
+    factor = RATE_LIMIT_CLIENT_FACTOR
+    slots = []
+    try:
+        retry_after = (_take_token(f"{kind}:ip:{client}", rate * factor, burst * factor)
+                       or _take_token(f"{kind}:session:{session}", rate, burst))
+        if retry_after:
+            metric_inc("rate_limit_rejections_total", kind=kind, reason="rate")
+            return "Too many requests. Please slow down.", retry_after, []
+        for key, cap in ((f"ip:{client}", SESSION_MAX_IN_FLIGHT * factor), (f"session:{session}", SESSION_MAX_IN_FLIGHT)):
+            slot_id = _acquire_slot(key, cap)
+            if slot_id is None:
+                release_rate_limit(slots)
+                metric_inc("rate_limit_rejections_total", kind=kind, reason="concurrency")
+                return "Too many requests in progress.", 1, []
+            slots.append(slot_id)
+    except sqlite3.Error:
+        release_rate_limit(slots)
+        logger.exception("Rate limiter unavailable; allowing request")
+        metric_inc("rate_limit_errors_total", kind=kind)
+        return None, 0, []
+    return None, 0, slots
+
+
+def release_rate_limit(slots):
+    for slot_id in slots:
+        _release_slot(slot_id)
+
+
+def claim_rate_limit_slots() -> list:
+    """Take this request's slots over from rate_limited(), for work that outlives the response."""
+    slots = g.get("rate_limit_slots")
+    if not slots:
+        return []
+    claimed = list(slots)
+    slots.clear()  # the response's close hook releases whatever is left in this list
+    return claimed
+
+
+def rate_limited(kind: str):
+    """Route decorator: acquire_rate_limit() for the caller before any model/DB work."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == "OPTIONS":
+                return view(*args, **kwargs)
+
+            client = client_address(request.remote_addr, request.headers.get("X-Forwarded-For", ""))
+            error, retry_after, slots = acquire_rate_limit(kind, _session_id(), client)
+            if error:
+                return _too_many_requests(error, retry_after)
+            g.rate_limit_slots = slots
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                release_rate_limit(slots)
+                raise
+            # Streamed responses hold the slots until the stream is closed
+            response.call_on_close(lambda: release_rate_limit(slots))
+            return response
+        return wrapper
+    return decorator
+
+
+def _normalize_origin(value: str) -> str:
+    return value.rstrip("/") if value else value
+
+
+def _cors_allowed_origins():
+    return [
+        "https://bakckend-koko.onrender.com",
+        "http://localhost:5173",
+    ]
+
+
+def _cors_allowed_origin():
+    origin = request.headers.get("Origin")
+    if not origin:
+        return ""
+    allowed_list = _cors_allowed_origins()
+    if "*" in allowed_list or origin in allowed_list:
+        return origin
+    return ""
+
+@bp.after_app_request
+def add_cors_headers(response):
+    allowed_origin = _cors_allowed_origin()
+    if allowed_origin:
+        response.headers["Access-Control-Allow-Origin"] = allowed_origin
+        response.headers["Vary"] = "Origin"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, DELETE, OPTIONS"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    return response
+
+
+
+SYSTEM_PROMPT = """
+
+Your name is Koko 🐨
+
+You are a koala-themed AI assistant for Healthcare Plus.
+
+You are a senior technical and operations assistant — calm, precise, and dependable.
+
+1. Personality & Tone
+
+Sound natural, friendly, and professional
+
+Use light, purposeful emojis to add warmth and clarity
+
+Avoid slang, overuse of emojis, or playful distractions
+
+Be concise, confident, and helpful
 
 Write like a trusted teammate, not a chatbot
 
@@ -676,24 +2867,128 @@ Tone and style
 
 conversation_history = [{"role": "system", "content": SYSTEM_PROMPT}]
 MAX_HISTORY_MESSAGES = 30  # keep it light
+HISTORY_TRIM_BLOCK = 10  # messages dropped at once when the cap is hit, so the kept prefix moves rarely
+
+# Tone picked in the frontend: one slot, sent at the tail of each turn (not piled up in the history)
+_tone_preference = {"mode": None}
+
+
+# -----------------------------
+# Context assembly
+# -----------------------------
+# Model input goes from most to least static: system prompt, schema digest, memories, history,
+# then this turn's directives. Consecutive requests then share a long identical prefix and the
+# provider's prompt cache can serve it; anything volatile sits after the cached part.
+def _trim_history():
+    """Cap the history (system prompt + last N messages), dropping a block at a time."""
+    if len(conversation_history) > (1 + MAX_HISTORY_MESSAGES):
+        keep = MAX_HISTORY_MESSAGES - HISTORY_TRIM_BLOCK
+        conversation_history[:] = [conversation_history[0]] + conversation_history[-keep:]
+
+
+def context_prefix(system_message: dict) -> list:
+    parts = [system_message]
+    try:
+        parts.append({"role": "system", "content": get_schema_digest()})
+    except Exception:
+        logger.exception("Schema digest unavailable; continuing without it")
+    memory_context = _format_memory_context(_load_memories())
+    if memory_context:
+        parts.append({"role": "system", "content": memory_context})
+    return parts
 
 
+def turn_directives(extra: List[str] = None) -> list:
+    """This turn's volatile instructions as one trailing system message (none -> empty list)."""
+    lines = list(extra or [])
+    if _tone_preference["mode"]:
+        lines.append(f"Tone preference: {_tone_preference['mode']}. Keep responses aligned to this tone.")
+    return [{"role": "system", "content": "\n".join(lines)}] if lines else []
 
 
-@app.route("/test_db")
+def build_model_input(history: list, extra_directives: List[str] = None) -> list:
+    return context_prefix(history[0]) + list(history[1:]) + turn_directives(extra_directives)
+
+
+@bp.route("/test_db")
 def test_db():
     rows = run_sql("SELECT NOW() AS server_time;")
     return jsonify(rows)
 
-@app.route("/")
+
+@bp.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@bp.route("/")
 def home():
     return jsonify({
         "status": "Koko backend is alive 🐨",
-        "endpoints": ["/test_db", "/chat_stream", "/memories", "/upload_doc", "/load_sheet", "/load_link", "/screen_snapshot"]
+        "endpoints": ["/test_db", "/metrics", "/warmup", "/chat_stream", "/memories", "/upload_doc", "/load_sheet", "/load_link", "/screen_snapshot", "/screen_snapshot_stream", "/chat_batch"]
     }), 200
 
 
-@app.route("/memories", methods=["GET", "POST", "DELETE", "OPTIONS"])
+_WARMUP_LOCK = threading.Lock()
+_WARMUP_STATE = {"executor": None, "pending": 0, "last": {}}  # last: session -> monotonic start
+
+
+def _warm_caches():
+    """Everything the first chat turn would otherwise pay for in sequence."""
+    started = time.monotonic()
+    steps = (
+        ("db", lambda: run_sql("SELECT 1 AS ok;")),
+        ("db_read", lambda: run_sql("SELECT 1 AS ok;", replica=True)),
+        ("model_client", get_client),
+        ("prompt_prefix", lambda: context_prefix(conversation_history[0])),  # schema digest + memories
+    )
+    for name, step in steps:
+        try:
+            step()
+        except Exception as exc:
+            metric_inc("warmup_step_failures_total", step=name)
+            logger.warning("Warmup step %s failed: %s", name, exc)
+    metric_observe("warmup_seconds", time.monotonic() - started)
+
+
+def _warmup_done(_future):
+    with _WARMUP_LOCK:
+        _WARMUP_STATE["pending"] -= 1
+
+
+def start_warmup(session_id: str) -> str:
+    """Queue a warmup unless this session had one recently or too many are already pending."""
+    now = time.monotonic()
+    with _WARMUP_LOCK:
+        last = _WARMUP_STATE["last"]
+        if now - last.get(session_id, float("-inf")) < WARMUP_MIN_INTERVAL_SECONDS:
+            outcome = "deduped"
+        elif _WARMUP_STATE["pending"] >= WARMUP_MAX_PENDING:
+            outcome = "busy"
+        else:
+            outcome = "started"
+            last[session_id] = now
+            if len(last) > WARMUP_MAX_SESSIONS:
+                for sid in [s for s, t in last.items() if now - t >= WARMUP_MIN_INTERVAL_SECONDS]:
+                    del last[sid]
+            _WARMUP_STATE["pending"] += 1
+            if _WARMUP_STATE["executor"] is None:
+                _WARMUP_STATE["executor"] = ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="koko-warmup")
+            executor = _WARMUP_STATE["executor"]
+    metric_inc("warmup_requests_total", outcome=outcome)
+    if outcome == "started":
+        executor.submit(_warm_caches).add_done_callback(_warmup_done)
+    return outcome
+
+
+@bp.route("/warmup", methods=["POST", "OPTIONS"])
+def warmup():
+    """Fire-and-forget: called by the frontend on input focus/typing, returns immediately."""
+    if request.method == "OPTIONS":
+        return "", 204
+    return jsonify({"warmup": start_warmup(_session_id())}), 202
+
+
+@bp.route("/memories", methods=["GET", "POST", "DELETE", "OPTIONS"])
 def memories():
     if request.method == "OPTIONS":
         return "", 204
@@ -721,7 +3016,8 @@ def memories():
     # Load memories (GET)
     return jsonify({"memories": _load_memories()})
 
-@app.route("/upload_doc", methods=["POST"])
+@bp.route("/upload_doc", methods=["POST"])
+@rate_limited("ingest")
 def upload_doc():
     file = request.files.get("file")
     if not file or not file.filename:
@@ -731,6 +3027,15 @@ def upload_doc():
     if not _is_allowed_doc(filename):
         return jsonify({"error": "Unsupported file type. Use .txt, .md, .csv, or .pdf."}), 400
 
+    if filename.lower().endswith(".csv"):
+        try:
+            table = ingest_csv(_session_id(), os.path.splitext(filename)[0], filename, file.stream)
+        except Exception as exc:
+            return jsonify({"error": f"Failed to read file: {exc}"}), 400
+        if not table.total_rows:
+            return jsonify({"error": "File appears to be empty."}), 400
+        return jsonify(_add_table_to_history(table, "Table uploaded. Ask me anything about it!"))
+
     try:
         content = _extract_text_from_upload(file)
     except Exception as exc:
@@ -748,8 +3053,7 @@ def upload_doc():
         "role": "user",
         "content": f"Document uploaded: {filename}\n\n{truncated}"
     })
-    if len(conversation_history) > (1 + MAX_HISTORY_MESSAGES):
-        conversation_history[:] = [conversation_history[0]] + conversation_history[-MAX_HISTORY_MESSAGES:]
+    _trim_history()
 
     return jsonify({
         "message": "Document uploaded. Ask me anything about it!",
@@ -758,59 +3062,117 @@ def upload_doc():
     })
 
 
-@app.route("/screen_snapshot", methods=["POST"])
+@bp.route("/screen_snapshot", methods=["POST"])
+@rate_limited("snapshot")
 def screen_snapshot():
-    payload = request.get_json(silent=True) or {}
-    raw_image = (payload.get("image") or "").strip()
-    prompt = (payload.get("prompt") or "Describe what you see on my screen.").strip()
-
-    if not raw_image:
-        return jsonify({"error": "No image provided."}), 400
-
-    # Extract base64 + mime from data URL if present
-    mime = "image/png"
-    image_b64 = raw_image
+    try:
+        image_bytes, mime, prompt = _read_snapshot_request()
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
 
-    if raw_image.startswith("data:"):
-        try:
-            header, encoded = raw_image.split(",", 1)  # data:image/png;base64,<...>
-            mime = header.split(";")[0].replace("data:", "") or "image/png"
-            if "image/" not in mime:
-                return jsonify({"error": "Unsupported image type."}), 400
-            image_b64 = encoded.strip()
-        except ValueError:
-            return jsonify({"error": "Invalid image data URL."}), 400
+    # Same screen + same question as a recent snapshot: answer from cache
+    cache_key = (hashlib.sha256(image_bytes).hexdigest(), prompt)
+    cached = _snapshot_cache_get(cache_key)
+    if cached is not None:
+        _record_snapshot_exchange(prompt, cached)
+        return jsonify({"message": cached, "cached": True}), 200
 
-    # Validate base64 (and catch padding issues)
     try:
-        base64.b64decode(image_b64, validate=True)
-    except Exception:
-        return jsonify({"error": "Invalid base64 image data."}), 400
-
-    data_url = f"data:{mime};base64,{image_b64}"
+        data_url = _snapshot_data_url(image_bytes, mime)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    del image_bytes
 
     try:
-        resp = client.responses.create(
-            model="gpt-5.2",
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": prompt},
-                        {"type": "input_image", "image_url": data_url},
-                    ],
-                }
-            ],
+        started = time.monotonic()
+        resp = create_response(
+            model=MODEL_VISION,
+            input=_snapshot_vision_input(prompt, data_url),
             max_output_tokens=400,
         )
-        return jsonify({"message": resp.output_text or ""}), 200
-
+        audit("model_round", session=_session_id(), kind="vision", model=getattr(resp, "model", None),
+              duration_ms=round((time.monotonic() - started) * 1000, 1))
+        message = resp.output_text or ""
+        if message:
+            _snapshot_cache_put(cache_key, message)
+            _record_snapshot_exchange(prompt, message)
+        return jsonify({"message": message}), 200
+
+    except ModelUnavailableError as e:
+        logger.warning("Vision model unavailable: %s", e)
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        app.logger.exception("OpenAI vision call failed")
+        logger.exception("OpenAI vision call failed")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/load_link", methods=["POST"])
+@bp.route("/screen_snapshot_stream", methods=["POST", "OPTIONS"])
+@rate_limited("snapshot")
+def screen_snapshot_stream():
+    if request.method == "OPTIONS":
+        return "", 204
+
+    try:
+        image_bytes, mime, prompt = _read_snapshot_request()
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    cache_key = (hashlib.sha256(image_bytes).hexdigest(), prompt)
+    cached = _snapshot_cache_get(cache_key)
+    data_url = None
+    if cached is None:
+        try:
+            data_url = _snapshot_data_url(image_bytes, mime)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+    del image_bytes
+
+    session_id = _session_id()
+
+    def generate():
+        yield f"data: {json.dumps({'delta': ''})}\n\n"
+
+        if cached is not None:
+            _record_snapshot_exchange(prompt, cached)
+            yield f"data: {json.dumps({'delta': cached})}\n\n"
+            yield f"data: {json.dumps({'done': True})}\n\n"
+            return
+
+        parts = []
+        completed = False
+        started = time.monotonic()
+        try:
+            for delta in stream_response_text(
+                model=MODEL_VISION,
+                input=_snapshot_vision_input(prompt, data_url),
+                max_output_tokens=400,
+            ):
+                parts.append(delta)
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+            completed = True
+
+        except ModelUnavailableError as e:
+            logger.warning("Vision model unavailable: %s", e)
+            yield f"data: {json.dumps({'delta': 'Koko is busy right now 🐨 Please try again in a moment.'})}\n\n"
+
+        except Exception as e:
+            logger.exception("OpenAI vision stream failed")
+            yield f"data: {json.dumps({'delta': f'[Server error] {str(e)}'})}\n\n"
+
+        message = "".join(parts)
+        audit("model_round", session=session_id, kind="vision_stream", model=MODEL_VISION, completed=completed,
+              output_chars=len(message), duration_ms=round((time.monotonic() - started) * 1000, 1))
+        # A stream cut off mid-answer is neither cached nor remembered
+        if completed and message.strip():
+            _snapshot_cache_put(cache_key, message)
+            _record_snapshot_exchange(prompt, message)
+        yield f"data: {json.dumps({'done': True})}\n\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+
+@bp.route("/load_link", methods=["POST"])
+@rate_limited("ingest")
 def load_link():
     payload = request.json or {}
     link_url = (payload.get("url") or "").strip()
@@ -834,15 +3196,15 @@ def load_link():
         "role": "user",
         "content": f"Link loaded ({link_url}):\n\n{truncated}"
     })
-    if len(conversation_history) > (1 + MAX_HISTORY_MESSAGES):
-        conversation_history[:] = [conversation_history[0]] + conversation_history[-MAX_HISTORY_MESSAGES:]
+    _trim_history()
 
     return jsonify({
         "message": "Link loaded. Ask me anything about it!",
         "chars": len(truncated)
     })
 
-@app.route("/load_sheet", methods=["POST"])
+@bp.route("/load_sheet", methods=["POST"])
+@rate_limited("ingest")
 def load_sheet():
     payload = request.json or {}
     sheet_url = (payload.get("url") or "").strip()
@@ -850,199 +3212,714 @@ def load_sheet():
         return jsonify({"error": "No Google Sheets URL provided."}), 400
 
     try:
-        content = fetch_sheet_csv(sheet_url)
+        export_url = _normalize_sheet_export_url(sheet_url)
+        name = "sheet_" + hashlib.sha1(export_url.encode("utf-8")).hexdigest()[:6]
+        with urlopen(export_url, timeout=15) as response:
+            table = ingest_csv(_session_id(), name, "Google Sheet", response)
     except Exception as exc:
         return jsonify({"error": f"Failed to read Google Sheet: {exc}"}), 400
 
-    content = content.strip()
-    if not content:
+    if not table.total_rows:
         return jsonify({"error": "Google Sheet appears to be empty."}), 400
 
-    truncated = content[:MAX_SHEET_CHARS]
-    if len(content) > MAX_SHEET_CHARS:
-        truncated += "\n\n[Sheet truncated]"
+    return jsonify(_add_table_to_history(table, "Google Sheet loaded. Ask me anything about it!"))
 
-    conversation_history.append({
-        "role": "user",
-        "content": f"Google Sheet loaded:\n\n{truncated}"
-    })
-    if len(conversation_history) > (1 + MAX_HISTORY_MESSAGES):
-        conversation_history[:] = [conversation_history[0]] + conversation_history[-MAX_HISTORY_MESSAGES:]
 
-    return jsonify({
-        "message": "Google Sheet loaded. Ask me anything about it!",
-        "chars": len(truncated)
-    })
+def _add_table_to_history(table: CsvTable, message: str) -> dict:
+    content = csv_table_prompt(table)
+    conversation_history.append({"role": "user", "content": content})
+    _trim_history()
+    return {
+        "message": message,
+        "table": table.name,
+        "rows": table.total_rows,
+        "columns": table.columns,
+        "chars": len(content),
+    }
 
 
-@app.route("/chat_stream", methods=["POST", "OPTIONS"])
-def chat_stream():
-    if request.method == "OPTIONS":
-        return "", 204
-    user_message = request.json.get("message", "")
-    tone_mode = request.json.get("tone")
+# -----------------------------
+# Resumable streams
+# -----------------------------
+# /chat_stream generation runs in its own thread and publishes events into a bounded per-run
+# buffer. The HTTP response just follows the buffer: every event has an id ("<run>-<seq>"), a
+# client that lost the connection reconnects with Last-Event-ID and gets the missed events
+# followed by the live ones, and idle stretches (long tool rounds) get heartbeat comments.
+# Events are also written to a SQLite file shared by the workers on the host, so a reconnect
+# routed to another worker replays from there. A retried POST carrying the same turn_id joins
+# the run already started instead of answering twice.
+_STREAM_STORE_LOCAL = threading.local()
+
+
+def _stream_store() -> sqlite3.Connection:
+    conn = getattr(_STREAM_STORE_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STREAM_STORE_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS runs (id TEXT PRIMARY KEY, session TEXT, turn TEXT, done INTEGER, updated REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS runs_turn ON runs (session, turn)")
+        conn.execute("CREATE TABLE IF NOT EXISTS events (run TEXT, seq INTEGER, data TEXT, PRIMARY KEY (run, seq))")
+        _STREAM_STORE_LOCAL.conn = conn
+    return conn
+
+
+def _store_stream(statements):
+    """Run (sql, params) pairs in one transaction; the shared store is best effort."""
+    try:
+        conn = _stream_store()
+        with conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+    except sqlite3.Error:
+        logger.exception("Stream store write failed; this stream resumes on this worker only")
+        metric_inc("chat_stream_store_errors_total")
+
+
+class _StreamRun:
+    __slots__ = ("id", "session_id", "turn_id", "events", "first_seq", "done", "finished_at", "cancelled", "cond")
+
+    def __init__(self, session_id: str, turn_id: str = None):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.turn_id = turn_id
+        self.events: List[str] = []  # JSON payloads; events[i] has seq first_seq + i
+        self.first_seq = 0
+        self.done = False
+        self.finished_at = None
+        self.cancelled = False  # evicted: the producer stops at its next event
+        self.cond = threading.Condition()
+
+    def publish(self, payload: dict):
+        data = json.dumps(payload)
+        with self.cond:
+            if self.done:
+                return
+            seq = self.first_seq + len(self.events)
+            self.events.append(data)
+            if len(self.events) > STREAM_REPLAY_MAX_EVENTS:
+                drop = len(self.events) - STREAM_REPLAY_MAX_EVENTS
+                del self.events[:drop]
+                self.first_seq += drop
+            if payload.get("done"):
+                self.finish()
+            self.cond.notify_all()
+        statements = [("INSERT OR REPLACE INTO events (run, seq, data) VALUES (?, ?, ?)", (self.id, seq, data))]
+        if payload.get("done"):
+            statements.append(("UPDATE runs SET done = 1, updated = ? WHERE id = ?", (time.time(), self.id)))
+        _store_stream(statements)
+
+    def finish(self):
+        with self.cond:
+            if not self.done:
+                self.done = True
+                self.finished_at = time.monotonic()
+            self.cond.notify_all()
+
+    def follow(self, after_seq: int = -1):
+        """SSE text for events after after_seq, live until the run is done; heartbeats while idle."""
+        next_seq = after_seq + 1
+        while True:
+            with self.cond:
+                if next_seq - self.first_seq >= len(self.events) and not self.done:
+                    self.cond.wait(STREAM_HEARTBEAT_SECONDS)
+                if next_seq < self.first_seq:
+                    metric_inc("chat_stream_replay_gaps_total")
+                    next_seq = self.first_seq
+                start = next_seq - self.first_seq
+                pending = self.events[start:]
+                done = self.done
+            if not pending:
+                if done:
+                    return
+                yield ": keepalive\n\n"
+                continue
+            for data in pending:
+                yield f"id: {self.id}-{next_seq}\ndata: {data}\n\n"
+                next_seq += 1
+
+
+class _StoredStreamRun:
+    """A run generated by another worker, followed through the shared store."""
+    __slots__ = ("id", "session_id")
+
+    def __init__(self, run_id: str, session_id: str):
+        self.id = run_id
+        self.session_id = session_id
+
+    def follow(self, after_seq: int = -1):
+        next_seq = after_seq + 1
+        idle_since = time.monotonic()
+        while True:
+            try:
+                conn = _stream_store()
+                row = conn.execute("SELECT done FROM runs WHERE id = ?", (self.id,)).fetchone()
+                # done is read first: once it is set, every event is already in the table
+                pending = conn.execute(
+                    "SELECT seq, data FROM events WHERE run = ? AND seq >= ? ORDER BY seq", (self.id, next_seq)
+                ).fetchall()
+            except sqlite3.Error:
+                logger.exception("Stream store read failed")
+                return
+            for seq, data in pending:
+                yield f"id: {self.id}-{seq}\ndata: {data}\n\n"
+                next_seq = seq + 1
+            if pending:
+                idle_since = time.monotonic()
+            elif row is None or row[0]:
+                return
+            elif time.monotonic() - idle_since >= STREAM_HEARTBEAT_SECONDS:
+                idle_since = time.monotonic()
+                yield ": keepalive\n\n"
+            else:
+                time.sleep(STREAM_STORE_POLL_SECONDS)
+
+
+_STREAM_RUNS: "OrderedDict[str, _StreamRun]" = OrderedDict()
+_STREAM_RUNS_LOCK = threading.Lock()
+_STREAM_PRODUCERS = threading.BoundedSemaphore(STREAM_MAX_PRODUCERS)
+
+
+def start_stream_run(session_id: str, generate, turn_id: str = None, on_finish=None):
+    """
+    Run generate() in a producer thread and return the run, or None when STREAM_MAX_PRODUCERS
+    answers are already generating. on_finish runs once the producer is done, e.g. to release
+    rate-limit slots: a client that disconnects does not free them early.
+    """
+    if not _STREAM_PRODUCERS.acquire(blocking=False):
+        metric_inc("chat_stream_rejected_total")
+        return None
+    run = _StreamRun(session_id, turn_id)
+    now = time.monotonic()
+    with _STREAM_RUNS_LOCK:
+        for rid, old in list(_STREAM_RUNS.items()):
+            if old.done and now - old.finished_at > STREAM_REPLAY_TTL_SECONDS:
+                del _STREAM_RUNS[rid]
+        while len(_STREAM_RUNS) >= STREAM_REPLAY_MAX_RUNS:
+            _, evicted = _STREAM_RUNS.popitem(last=False)
+            evicted.cancelled = True
+        _STREAM_RUNS[run.id] = run
+    wall = time.time()
+    _store_stream([
+        ("INSERT INTO runs (id, session, turn, done, updated) VALUES (?, ?, ?, 0, ?)", (run.id, session_id, turn_id, wall)),
+        # Finished runs past the replay window, and runs a crashed worker never finished
+        ("DELETE FROM events WHERE run IN (SELECT id FROM runs WHERE updated < ? AND (done OR updated < ?))",
+         (wall - STREAM_REPLAY_TTL_SECONDS, wall - 3600)),
+        ("DELETE FROM runs WHERE updated < ? AND (done OR updated < ?)", (wall - STREAM_REPLAY_TTL_SECONDS, wall - 3600)),
+    ])
+
+    def produce():
+        events = generate()
+        try:
+            for payload in events:
+                if run.cancelled:
+                    metric_inc("chat_stream_cancelled_total")
+                    break
+                run.publish(payload)
+        except Exception:
+            logger.exception("Stream generation failed")
+            run.publish({"delta": "[Server error] generation stopped."})
+        finally:
+            getattr(events, "close", lambda: None)()
+            run.publish({"done": True})  # no-op if generate() already sent it
+            _STREAM_PRODUCERS.release()
+            if on_finish:
+                on_finish()
+
+    threading.Thread(target=produce, daemon=True, name=f"koko-stream-{run.id[:8]}").start()
+    return run
+
+
+def get_stream_run(run_id: str, session_id: str):
+    with _STREAM_RUNS_LOCK:
+        run = _STREAM_RUNS.get(run_id)
+    if run is None:
+        try:
+            row = _stream_store().execute("SELECT session FROM runs WHERE id = ?", (run_id,)).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is not None:
+            run = _StoredStreamRun(run_id, row[0])
+    # Only the session that started a stream may pick it up again
+    if run is None or run.session_id != session_id:
+        return None
+    return run
+
+
+def find_turn_run(session_id: str, turn_id: str):
+    """The run already answering this (session, turn_id), on any worker, else None."""
+    with _STREAM_RUNS_LOCK:
+        for run in _STREAM_RUNS.values():
+            if run.turn_id == turn_id and run.session_id == session_id:
+                return run
+    try:
+        row = _stream_store().execute(
+            "SELECT id FROM runs WHERE session = ? AND turn = ? ORDER BY updated DESC LIMIT 1", (session_id, turn_id)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    return get_stream_run(row[0], session_id) if row else None
+
+
+def parse_last_event_id(value):
+    """ "<run id>-<seq>" -> (run id, seq), else None."""
+    run_id, _, seq = str(value or "").strip().rpartition("-")
+    if not run_id or not seq.isdigit():
+        return None
+    return run_id, int(seq)
+
+
+def _sse_response(run, after_seq: int = -1) -> Response:
+    response = Response(run.follow(after_seq), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx: pass events through unbuffered
+    response.headers["X-Stream-Id"] = run.id
+    return response
+
+
+class SharedSqlResults:
+    """Batch-scoped single flight: identical SQL (+params) runs once, concurrent askers wait for it."""
+
+    def __init__(self):
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def run(self, sql: str, params=None) -> dict:
+        key = sql + "\0" + json.dumps(params, sort_keys=True, default=str)
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if not owner:
+            metric_inc("chat_batch_sql_dedup_total")
+            return future.result()
+        try:
+            result = run_model_sql(sql, params)
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        future.set_result(result)
+        return result
+
+
+def run_chat_turn(user_message: str, current_input: list, session_id: str, sql_results=None):
+    """
+    Run one chat turn through the tool loop and return (final_text, last_sql).
+    current_input is the full model input (system prompt, context, history, user message).
+    sql_results: optional SharedSqlResults so identical SQL across a batch runs once.
+    """
+    turn = stream_chat_turn(user_message, current_input, session_id, sql_results, live=False)
+    while True:
+        try:
+            next(turn)
+        except StopIteration as done:
+            return done.value
+
+
+def stream_chat_turn(user_message: str, current_input: list, session_id: str, sql_results=None,
+                     live: bool = True):
+    """
+    run_chat_turn as a generator: with live=True every model round is streamed and the answer's
+    text deltas are yielded as the model writes them; returns (final_text, last_sql).
+    live=False uses whole (retried, hedged) responses and yields nothing.
+    """
+    execute_sql = sql_results.run if sql_results is not None else run_model_sql
+
+    final_text = ""
+    shown_text = ""
+    last_sql = {"query": None, "columns": [], "rows": [], "summary": None}
+    successful_sql = []
+    loop = ToolLoopController(user_message)
+
+    # Fast path: a learned template answers this question shape, no tool rounds needed
+    template = match_sql_template(user_message)
+    if template:
+        template_sql, template_params = template
+        started = time.monotonic()
+        try:
+            result = execute_sql(template_sql, template_params)
+        except Exception:
+            logger.exception("SQL template failed; falling back to tool rounds")
+            result = {"error": "template failed"}
+        audit("tool_call", session=session_id, tool="query_sql", sql=template_sql, params=template_params,
+              rows=result.get("row_count", 0), error=result.get("error"), cache_hit="template",
+              duration_ms=round((time.monotonic() - started) * 1000, 1))
+        if "error" in result:
+            metric_inc("sql_template_lookups_total", outcome="error")
+        else:
+            last_sql["query"] = f"{template_sql} -- params: {json.dumps(template_params)}"
+            last_sql["columns"] = result["columns"]
+            last_sql["rows"] = result["rows"]
+            last_sql["summary"] = result.get("summary")
+            current_input = current_input + [{
+                "role": "system",
+                "content": "Live SQL results for the latest question:\n"
+                           f"SQL: {last_sql['query']}\nResult: {json.dumps(result)}"
+            }]
+            loop.force_stop("sql_template")
+
+    while True:
+        final_round = loop.should_stop()
+        if final_round:
+            current_input = current_input + [{
+                "role": "user",
+                "content": FORCED_ANSWER_PROMPT if last_sql["query"] else "Answer now using the information above."
+            }]
+
+        round_started = time.monotonic()
+        round_args = dict(
+            input=current_input,
+            tools=[{"type": "web_search"}, SQL_TOOL, SCHEMA_TOOL],
+            tool_choice="none" if final_round else "auto",
+            max_output_tokens=500
+        )
+        if live:
+            resp = yield from stream_response(**round_args)
+            if resp is None:
+                raise ModelUnavailableError("Chat model stream ended without a response")
+        else:
+            resp = create_response(**round_args)
+        loop.record_round(resp)
+
+        tool_calls = [
+            item for item in (resp.output or [])
+            if getattr(item, "type", None) == "function_call"
+        ]
+        usage = getattr(resp, "usage", None)
+        audit("model_round", session=session_id, round=loop.rounds, model=getattr(resp, "model", None),
+              final=final_round, tool_calls=[c.name for c in tool_calls],
+              input_tokens=getattr(usage, "input_tokens", None), cached_tokens=cached_input_tokens(usage),
+              output_tokens=getattr(usage, "output_tokens", None),
+              duration_ms=round((time.monotonic() - round_started) * 1000, 1))
+
+        # If no tool calls, we got the final answer
+        if final_round or not tool_calls:
+            final_text = shown_text + (resp.output_text or "")
+            if final_text.strip() or final_round:
+                break
+            loop.force_stop("empty_answer")
+            continue
+        if live:
+            shown_text += resp.output_text or ""  # text the model wrote before its tool calls went out too
+
+        tool_outputs = []
+
+        for call in tool_calls:
+            name = call.name
+            args = json.loads(call.arguments or "{}")
+            call_started = time.monotonic()
+            sql_text = None
+
+            # Identical call earlier in this request: reuse its output
+            memo = loop.memo_get(name, args)
+            if memo is not None:
+                audit("tool_call", session=session_id, tool=name, **memo["audit"], cache_hit="memo", duration_ms=0.0)
+                tool_outputs.append({
+                    "type": "function_call_output",
+                    "call_id": call.call_id,
+                    "output": memo["output"]
+                })
+                continue
+
+            if name == "get_schema":
+                mode = args.get("mode")
+                table = args.get("table")
+                column = args.get("column")
+                limit = args.get("limit", 50)
+
+                schema_rows = get_schema(mode, table=table, column=column, limit=limit)
+                if schema_rows and "error" in schema_rows[0]:
+                    tool_result = schema_rows[0]
+                else:
+                    tool_result = ColumnarRows.from_records(schema_rows).to_payload()
+
+            elif name == "query_sql":
+                q = (args.get("query") or "").strip()
+
+                bad = ["%s", "$1", "$2"]
+                if any(b in q for b in bad):
+                    tool_result = {"error": "Placeholders are not allowed. Write full SQL without %s/$1 params."}
+                elif not q.lower().startswith("select"):
+                    tool_result = {"error": "Only SELECT queries are allowed."}
+                else:
+                    local = args.get("target") == "local"
+                    q2 = q if local else rewrite_sql(user_message, q)      # ✅ auto-fix branch/month
+                    sql_text = q2
+                    tool_result = run_local_sql(session_id, q2) if local else execute_sql(q2)
+                    if "rows" in tool_result:
+                        last_sql["query"] = q2
+                        last_sql["columns"] = tool_result["columns"]
+                        last_sql["rows"] = tool_result["rows"]
+                        last_sql["summary"] = tool_result.get("summary")
+                        if not local:
+                            successful_sql.append(q2)  # templates replay against Postgres only
+                        loop.note_sql_rows(tool_result["rows"])
+
+                tool_result = json_safe(tool_result)
+
+            else:
+                tool_result = {"error": f"Unknown tool: {name}"}
+
+            output = json.dumps(tool_result)
+            audit_fields = {"args": None if sql_text else args, "sql": sql_text,
+                            "rows": tool_result.get("row_count", 0), "error": tool_result.get("error")}
+            loop.memo_put(name, args, output, audit_fields)
+            audit("tool_call", session=session_id, tool=name, **audit_fields, cache_hit=None,
+                  duration_ms=round((time.monotonic() - call_started) * 1000, 1))
+            tool_outputs.append({
+                "type": "function_call_output",
+                "call_id": call.call_id,
+                "output": output
+            })
+
+        # Accumulate tool context across rounds
+        current_input = current_input + (resp.output or []) + tool_outputs
+
+    loop.finish()
+
+    # One query answered the question: remember its shape for next time
+    if len(set(successful_sql)) == 1 and final_text.strip():
+        learn_sql_template(user_message, successful_sql[0])
+
+    if not final_text.strip():
+        final_text = "I ran the database query, but didn’t get a readable response back. Try re-asking in a simpler way (ex: 'Active clients in Aurora for Dec 2024')."
+        if live:
+            yield final_text
+
+    return final_text, last_sql
 
+
+# -----------------------------
+# Chat turn engine (shared by /chat_stream and link.py's /chat)
+# -----------------------------
+def begin_chat_turn(user_message: str, tone_mode: str = None) -> List[str]:
+    """Records the user's message in the shared history; returns directives for this turn."""
     memory_text = _extract_memory_command(user_message)
 
+    directives = []
     if memory_text:
         entry = _save_memory(memory_text)
-        conversation_history.append({
-            "role": "system",
-            "content": f"Memory saved: {entry['text']}"
-        })
+        directives.append(f"Memory saved: {entry['text']}")
 
     if tone_mode:
-        conversation_history.append({
-            "role": "system",
-            "content": f"Tone preference: {tone_mode}. Keep responses aligned to this tone."
-        })
+        _tone_preference["mode"] = tone_mode
 
     # Save user message to history
     conversation_history.append({"role": "user", "content": user_message})
 
-    # Cap history (keep system + last N messages)
-    if len(conversation_history) > (1 + MAX_HISTORY_MESSAGES):
-        conversation_history[:] = [conversation_history[0]] + conversation_history[-MAX_HISTORY_MESSAGES:]
+    _trim_history()
+    return directives
 
-    def generate():
-        yield f"data: {json.dumps({'delta': ''})}\n\n"
 
-        try:
-            current_input = list(conversation_history)
-            memory_context = _format_memory_context(_load_memories())
-            if memory_context:
-                current_input = [
-                    current_input[0],
-                    {"role": "system", "content": memory_context},
-                ] + current_input[1:]
-
-            final_text = ""
-            last_sql = {"query": None, "rows": []}
-            max_rounds = 6
-
-
-            for _ in range(max_rounds):
-                resp = client.responses.create(
-                    model="gpt-5.1",
-                    input=current_input,
-                    tools=[{"type": "web_search"}, SQL_TOOL, SCHEMA_TOOL],
-                    tool_choice="auto",
-                    max_output_tokens=500
-                )
+def chat_turn_events(user_message: str, session_id: str, directives: List[str],
+                     want_chart: bool = False, live: bool = True):
+    """
+    Answers one turn as stream payloads ({"delta"}, {"chart"}, {"done"}); live=False waits for
+    whole model responses instead of streaming them. A failed turn still sends its apology
+    as a delta, then {"error", "status"}.
+    """
+    yield {"delta": ""}
 
-                tool_calls = [
-                    item for item in (resp.output or [])
-                    if getattr(item, "type", None) == "function_call"
-                ]
+    try:
+        current_input = build_model_input(list(conversation_history), directives)
 
-                # If no tool calls, we got the final answer
-                if not tool_calls:
-                    final_text = resp.output_text or ""
-                    break
+        # Emails are normalized as the model writes them: header first, body as it comes, sign-off at the end
+        email = StreamingEmailFormatter() if _wants_structured_email(user_message) else None
+        shown = []
+        turn = stream_chat_turn(user_message, current_input, session_id, live=live)
+        while True:
+            try:
+                delta = next(turn)
+            except StopIteration as done:
+                final_text, last_sql = done.value
+                break
+            if email:
+                delta = email.feed(delta)
+            if delta:
+                shown.append(delta)
+                yield {"delta": delta}
+
+        # ✅ Append SQL proof AFTER tools have run
+        tail = ""
+        if SHOW_SQL_PROOF and last_sql["query"] and isinstance(last_sql["rows"], list):
+            preview = [dict(zip(last_sql["columns"], row)) for row in last_sql["rows"][:5]]
+            tail += "\n\n---\nSQL used:\n" + last_sql["query"]
+            tail += "\n\nSQL result preview (first 5 rows):\n" + json.dumps(preview, indent=2)
+        if not live:
+            tail = final_text + tail
+        if email:
+            tail = email.feed(tail) + email.finish()
+        if tail:
+            shown.append(tail)
+            yield {"delta": tail}
+
+        # Optional chart series for the frontend
+        chart = chart_from_summary(last_sql.get("summary")) if want_chart else None
+        if chart:
+            yield {"chart": chart}
+
+        full = "".join(shown)
+        if full.strip():
+            conversation_history.append({"role": "assistant", "content": full})
+
+        yield {"done": True}
+
+    except ModelUnavailableError as e:
+        logger.warning("Chat model unavailable: %s", e)
+        yield {"delta": "Koko is busy right now 🐨 Please try again in a moment."}
+        yield {"error": str(e), "status": 503}
+        yield {"done": True}
 
-                tool_outputs = []
-
-                for call in tool_calls:
-                    name = call.name
-                    args = json.loads(call.arguments or "{}")
-
-                    if name == "get_schema":
-                        mode = args.get("mode")
-                        table = args.get("table")
-                        column = args.get("column")
-                        limit = args.get("limit", 50)
-
-                        tool_result = {"rows": get_schema(mode, table=table, column=column, limit=limit)}
-                        tool_result = json_safe(tool_result)
-
-                        tool_outputs.append({
-                            "type": "function_call_output",
-                            "call_id": call.call_id,
-                            "output": json.dumps(tool_result)
-                        })
-
-                    elif name == "query_sql":
-                        q = (args.get("query") or "").strip()
-
-                        bad = ["%s", "$1", "$2"]
-                        if any(b in q for b in bad):
-                            tool_result = {"error": "Placeholders are not allowed. Write full SQL without %s/$1 params."}
-                        elif not q.lower().startswith("select"):
-                            tool_result = {"error": "Only SELECT queries are allowed."}
-                        else:
-                            q2 = rewrite_sql(user_message, q)      # ✅ auto-fix branch/month
-                            tool_result = {"rows": run_sql(q2)}
-                            last_sql["query"] = q2
-                            last_sql["rows"] = tool_result["rows"]
-                        
-
-                        tool_result = json_safe(tool_result)
-
-                        tool_outputs.append({
-                            "type": "function_call_output",
-                            "call_id": call.call_id,
-                            "output": json.dumps(tool_result)
-                        })
-
-                # Accumulate tool context across rounds
-                current_input = current_input + (resp.output or []) + tool_outputs
-
-            # Force one final answer if we ended on tool calls
-            if not (final_text or "").strip():
-                current_input = current_input + [{
-                        "role": "user",
-                        "content": "Answer ONLY using the SQL results above. If a count exists in the rows, use that number exactly."
-                    }]
-                
-                resp2 = client.responses.create(
-                    model="gpt-5.1",
-                    input=current_input,
-                    tool_choice="none",
-                    max_output_tokens=500
-                )
+    except Exception as e:
+        logger.exception("Chat turn failed")
+        yield {"delta": f"[Server error] {str(e)}"}
+        yield {"error": str(e), "status": 500}
+        yield {"done": True}
+
+
+@bp.route("/chat_stream", methods=["POST", "OPTIONS"])
+@rate_limited("chat")
+def chat_stream():
+    if request.method == "OPTIONS":
+        return "", 204
+
+    # Reconnect after a dropped stream: replay from the buffer, don't re-run the turn
+    resume = parse_last_event_id(
+        request.headers.get("Last-Event-ID") or (request.get_json(silent=True) or {}).get("last_event_id")
+    )
+    if resume:
+        run = get_stream_run(resume[0], _session_id())
+        if run is None:
+            return jsonify({"error": "Stream expired; ask again."}), 410
+        metric_inc("chat_stream_resumes_total")
+        return _sse_response(run, after_seq=resume[1])
+
+    user_message = request.json.get("message", "")
+    tone_mode = request.json.get("tone")
+    want_chart = bool(request.json.get("charts"))
+    turn_id = str(request.json.get("turn_id") or "")[:64] or None
+    session_id = _session_id()
 
-                final_text = resp2.output_text or ""
+    # Retried POST (the first response died before any event id): join that run, don't answer twice
+    if turn_id:
+        run = find_turn_run(session_id, turn_id)
+        if run is not None:
+            metric_inc("chat_stream_resumes_total")
+            return _sse_response(run)
 
-                if not final_text.strip():
-                    final_text = "I ran the database query, but didn’t get a readable response back. Try re-asking in a simpler way (ex: 'Active clients in Aurora for Dec 2024')."
+    def generate():
+        directives = begin_chat_turn(user_message, tone_mode)
+        yield from chat_turn_events(user_message, session_id, directives, want_chart)
+
+    # Generation runs off the request thread, so a dropped connection doesn't lose the answer.
+    # It keeps this request's rate-limit slots until it finishes, not until the client goes away.
+    slots = claim_rate_limit_slots()
+    run = start_stream_run(session_id, generate, turn_id=turn_id, on_finish=lambda: release_rate_limit(slots))
+    if run is None:
+        release_rate_limit(slots)
+        return jsonify({"error": "Koko is busy right now. Please try again in a moment."}), 503
+    return _sse_response(run)
+
+
+@bp.route("/chat_batch", methods=["POST", "OPTIONS"])
+@rate_limited("batch")
+def chat_batch():
+    if request.method == "OPTIONS":
+        return "", 204
 
+    payload = request.get_json(silent=True) or {}
+    questions = payload.get("questions")
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"error": "Provide a non-empty \"questions\" array."}), 400
+    questions = [str(q).strip() for q in questions]
+    if len(questions) > CHAT_BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"At most {CHAT_BATCH_MAX_QUESTIONS} questions per batch."}), 400
 
-            # ✅ Append SQL proof AFTER tools have run
-            if SHOW_SQL_PROOF and last_sql["query"] and isinstance(last_sql["rows"], list):
-                preview = last_sql["rows"][:5]
-                final_text += "\n\n---\nSQL used:\n" + last_sql["query"]
-                final_text += "\n\nSQL result preview (first 5 rows):\n" + json.dumps(preview, indent=2)
+    session_id = _session_id()
 
-            if _wants_structured_email(user_message):
-                final_text = ensure_structured_email(final_text)
+    def generate():
+        # Shared by every question: the same cacheable prefix as /chat_stream, one SQL result set
+        base_input = context_prefix(conversation_history[0])
+        tail = turn_directives()
+        sql_results = SharedSqlResults()
+
+        def answer(index: int, question: str) -> dict:
+            if not question:
+                return {"index": index, "question": question, "error": "Empty question."}
+            try:
+                text, last_sql = run_chat_turn(
+                    question, base_input + [{"role": "user", "content": question}] + tail, session_id, sql_results
+                )
+            except ModelUnavailableError:
+                return {"index": index, "question": question, "error": "Model temporarily unavailable."}
+            except Exception as exc:
+                logger.exception("Batch question failed")
+                return {"index": index, "question": question, "error": str(exc)}
+            return {"index": index, "question": question, "answer": text, "sql": last_sql["query"]}
 
-            
-            # Stream final answer
-            time.sleep(STREAM_INITIAL_DELAY_SECONDS)
-            chunk_size = STREAM_CHUNK_SIZE
-            full = ""
-            for i in range(0, len(final_text), chunk_size):
-                chunk = final_text[i:i + chunk_size]
-                full += chunk
-                yield f"data: {json.dumps({'delta': chunk})}\n\n"
-                time.sleep(STREAM_CHUNK_DELAY_SECONDS)
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=CHAT_BATCH_CONCURRENCY, thread_name_prefix="koko-batch")
+        try:
+            futures = [executor.submit(answer, i, q) for i, q in enumerate(questions)]
+            for future in as_completed(futures):
+                yield json.dumps(json_safe(future.result()), ensure_ascii=False) + "\n"
+        finally:
+            # Client went away: don't start the remaining questions
+            executor.shutdown(wait=False, cancel_futures=True)
+        metric_observe("chat_batch_seconds", time.monotonic() - started)
+        metric_observe("chat_batch_questions", len(questions))
+        yield json.dumps({"done": True, "count": len(questions)}) + "\n"
 
-            if full.strip():
-                conversation_history.append({"role": "assistant", "content": full})
+    return Response(generate(), mimetype="application/x-ndjson")
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
 
-        except Exception as e:
-            yield f"data: {json.dumps({'delta': f'[Server error] {str(e)}'})}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
+# -----------------------------
+# App factory
+# -----------------------------
+_APP = None
+_APP_LOCK = threading.Lock()
 
-    # ✅ THIS LINE MUST EXIST and must be at this indentation level
-    return Response(generate(), mimetype="text/event-stream")
+
+def create_app() -> Flask:
+    """
+    Build (once) and return the Flask app. Loads config eagerly so that with gunicorn
+    preload_app (see gunicorn.conf.py) workers share it copy-on-write; model and DB
+    clients stay lazy and are created per worker.
+    """
+    global _APP
+    with _APP_LOCK:
+        if _APP is not None:
+            return _APP
+
+        from flask_cors import CORS
+
+        get_config()
+        flask_app = Flask(__name__)
+        # Registered before the blueprint so add_cors_headers runs first, as before
+        CORS(
+            flask_app,
+            origins=[
+                "https://backkend-koko-frontend.onrender.com",
+                "https://bakckend-koko-frontend.onrender.com",
+                "http://localhost:5173",
+            ],
+        )
+        flask_app.register_blueprint(bp)
+        _APP = flask_app
+        return _APP
+
+
+def __getattr__(name):
+    # Keeps `gunicorn app:app` and `from app import app` working without building at import
+    if name == "app":
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    create_app().run(host="0.0.0.0", port=port, debug=False)
 
 
 
@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+from collections import defaultdict
+
+from app import AUDIT_LOG_PATH, AUDIT_LOG_BACKUPS, _normalize_sql_for_plan
+
+# Slowest and most frequent SQL from the audit log, to decide what to index or cache.
+#   py audit_report.py                 (current log + rotated backups)
+#   py audit_report.py --top 20 --session abc123
+
+
+def _read_records(path: str):
+    paths = [f"{path}.{i}" for i in range(AUDIT_LOG_BACKUPS, 0, -1)] + [path]
+    for p in paths:
+        if not os.path.exists(p):
+            continue
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on Koko's SQL / tool-call audit log.")
+    parser.add_argument("--path", default=AUDIT_LOG_PATH)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--session", help="only records for this session id")
+    args = parser.parse_args()
+
+    stats = defaultdict(lambda: {"durations": [], "rows": [], "cache_hits": 0, "errors": 0, "example": ""})
+    rounds = []
+    input_tokens = cached_tokens = 0
+    for rec in _read_records(args.path):
+        if args.session and rec.get("session") != args.session:
+            continue
+        if rec.get("event") == "model_round":
+            rounds.append(rec.get("duration_ms") or 0)
+            input_tokens += rec.get("input_tokens") or 0
+            cached_tokens += rec.get("cached_tokens") or 0
+            continue
+        if rec.get("event") != "tool_call" or not rec.get("sql"):
+            continue
+        entry = stats[_normalize_sql_for_plan(rec["sql"])]
+        entry["durations"].append(rec.get("duration_ms") or 0)
+        entry["rows"].append(rec.get("rows") or 0)
+        entry["cache_hits"] += 1 if rec.get("cache_hit") else 0
+        entry["errors"] += 1 if rec.get("error") else 0
+        entry["example"] = rec["sql"]
+
+    if not stats:
+        print("No SQL tool calls in the audit log.")
+        return
+
+    def row(sql_key, entry):
+        d = entry["durations"]
+        return (
+            f"{len(d):6d}  {sum(d) / len(d):9.1f}  {_percentile(d, 0.95):9.1f}  {max(d):9.1f}  "
+            f"{sum(entry['rows']) / len(d):8.1f}  {entry['cache_hits'] / len(d):5.0%}  {entry['errors']:4d}  "
+            f"{entry['example'][:120]}"
+        )
+
+    header = f"{'calls':>6}  {'avg ms':>9}  {'p95 ms':>9}  {'max ms':>9}  {'avg rows':>8}  {'cache':>5}  {'errs':>4}  sql"
+
+    print(f"Slowest queries (by p95), top {args.top}:")
+    print(header)
+    for key, entry in sorted(stats.items(), key=lambda kv: _percentile(kv[1]["durations"], 0.95), reverse=True)[:args.top]:
+        print(row(key, entry))
+
+    print(f"\nMost frequent queries, top {args.top}:")
+    print(header)
+    for key, entry in sorted(stats.items(), key=lambda kv: len(kv[1]["durations"]), reverse=True)[:args.top]:
+        print(row(key, entry))
+
+    if rounds:
+        print(f"\nModel rounds: {len(rounds)}  avg {sum(rounds) / len(rounds):.1f} ms  p95 {_percentile(rounds, 0.95):.1f} ms")
+        if input_tokens:
+            print(f"Prompt cache: {cached_tokens} of {input_tokens} input tokens cached ({cached_tokens / input_tokens:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import os
+
+# gunicorn -c gunicorn.conf.py
+wsgi_app = "app:create_app()"
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Load app.py and config once in the master; workers share it copy-on-write.
+# OpenAI/DB clients are created lazily inside each worker after the fork.
+preload_app = True
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"  # SSE streams hold a thread for the whole answer
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 120
@@ -1,41 +1,177 @@
-from fastapi import FastAPI, Header, HTTPException
+import hashlib
+import hmac
+import os
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional
+
+from a2wsgi import WSGIMiddleware
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from starlette.concurrency import run_in_threadpool
+
+from app import (
+    acquire_rate_limit,
+    begin_chat_turn,
+    chat_turn_events,
+    client_address,
+    create_app,
+    find_turn_run,
+    get_stream_run,
+    metric_inc,
+    parse_last_event_id,
+    release_rate_limit,
+    start_stream_run,
+    start_warmup,
+)
+
+# KOKO API for programmatic clients: a thin async front end over app.py's chat engine, so
+# /chat shares the history, memories, caches, DB pools and model client with /chat_stream.
+#   uvicorn link:app --port 8000     (this API plus every Flask route, one warm process)
+# Keys come from KOKO_API_KEYS (comma-separated) and are sent as the X-Api-Key header.
+
+API_PATHS = {"/chat", "/docs", "/openapi.json"}
+FLASK_WORKERS = 16  # threads for Flask requests; each open SSE stream holds one
+
+
+@asynccontextmanager
+async def lifespan(_):
+    start_warmup("link")
+    yield
 
-app = FastAPI(title="KOKO API")
 
-app.add_middleware(
+api = FastAPI(title="KOKO API", lifespan=lifespan)
+
+api.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
+    allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id"],
 )
 
-API_KEY = "CHANGE_ME_KOKO"
-client = OpenAI()
 
 class ChatIn(BaseModel):
     message: str
+    session_id: Optional[str] = None
+    tone: Optional[str] = None
+    stream: bool = False
+    turn_id: Optional[str] = None  # resend on a retried request so the turn is answered once
+
 
-@app.get("/")
-def home():
-    return {"status": "ok", "ai": "KOKO"}
+@lru_cache(maxsize=1)
+def _api_key_digests() -> tuple:
+    keys = [k.strip() for k in os.environ.get("KOKO_API_KEYS", "").split(",") if k.strip()]
+    return tuple(hashlib.sha256(k.encode()).digest() for k in keys)
 
 
-@app.post("/chat")
-def chat(data: ChatIn, x_api_key: str = Header(default="")):
-    if x_api_key != API_KEY:
+def _check_api_key(x_api_key: Optional[str]):
+    # Compare fixed-size digests against every key so timing says nothing about which one was close
+    given = hashlib.sha256((x_api_key or "").encode()).digest()
+    matched = False
+    for digest in _api_key_digests():
+        matched |= hmac.compare_digest(given, digest)
+    if not matched:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are KOKO, a helpful AI assistant."},
-            {"role": "user", "content": data.message}
-        ]
+
+def _session_id(request: Request, data: Optional[ChatIn] = None) -> str:
+    """Same rules as app._session_id, so a client keeps one session across both frontends."""
+    sid = request.headers.get("X-Session-Id") or (data.session_id if data else None)
+    if not sid:
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        sid = forwarded.split(",")[0].strip() or (request.client.host if request.client else "") or "anonymous"
+    return str(sid)[:128]
+
+
+def _too_many_requests(message: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        {"error": message}, status_code=429, headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
     )
 
-    return {
-        "reply": response.choices[0].message.content
-    }
\ No newline at end of file
+
+def _sse_response(run, after_seq: int = -1) -> StreamingResponse:
+    return StreamingResponse(
+        run.follow(after_seq),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Stream-Id": run.id},
+    )
+
+
+@api.post("/chat")
+async def chat(
+    data: ChatIn,
+    request: Request,
+    x_api_key: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None),
+):
+    _check_api_key(x_api_key)
+    session_id = _session_id(request, data)
+
+    # Reconnect after a dropped stream: replay from the buffer, don't re-run the turn
+    resume = parse_last_event_id(last_event_id)
+    if resume:
+        run = await run_in_threadpool(get_stream_run, resume[0], session_id)
+        if run is None:
+            return JSONResponse({"error": "Stream expired; ask again."}, status_code=410)
+        metric_inc("chat_stream_resumes_total")
+        return _sse_response(run, after_seq=resume[1])
+
+    stream = data.stream or "text/event-stream" in request.headers.get("accept", "")
+    turn_id = (data.turn_id or "")[:64] or None
+    if stream and turn_id:
+        run = await run_in_threadpool(find_turn_run, session_id, turn_id)
+        if run is not None:
+            metric_inc("chat_stream_resumes_total")
+            return _sse_response(run)
+
+    # Same limiter as the Flask "chat" routes: per client address and per session
+    client = client_address(request.client.host if request.client else "", request.headers.get("X-Forwarded-For", ""))
+    error, retry_after, slots = await run_in_threadpool(acquire_rate_limit, "chat", session_id, client)
+    if error:
+        return _too_many_requests(error, retry_after)
+
+    def generate(live: bool = True):
+        directives = begin_chat_turn(data.message, data.tone)
+        yield from chat_turn_events(data.message, session_id, directives, live=live)
+
+    if stream:
+        # The producer holds the slots until the answer is generated, even if the client leaves
+        run = await run_in_threadpool(
+            start_stream_run, session_id, generate, turn_id=turn_id, on_finish=lambda: release_rate_limit(slots)
+        )
+        if run is None:
+            await run_in_threadpool(release_rate_limit, slots)
+            return JSONResponse({"error": "Koko is busy right now. Please try again in a moment."}, status_code=503)
+        return _sse_response(run)
+
+    def answer():
+        parts, failure = [], None
+        for payload in generate(live=False):
+            if "error" in payload:
+                failure = payload
+            parts.append(payload.get("delta", ""))
+        return "".join(parts), failure
+
+    try:
+        reply, failure = await run_in_threadpool(answer)
+    finally:
+        await run_in_threadpool(release_rate_limit, slots)
+    if failure:
+        # Same shape as the Flask endpoints: 503 when the model is unavailable, 500 otherwise
+        return JSONResponse({"error": failure["error"]}, status_code=failure["status"])
+    return {"reply": reply}
+
+
+_flask = WSGIMiddleware(create_app(), workers=FLASK_WORKERS)
+
+
+async def app(scope, receive, send):
+    """API paths (and lifespan) go to FastAPI; everything else, "/" included, to the Flask app with its own CORS rules."""
+    if scope["type"] == "lifespan" or scope.get("path") in API_PATHS:
+        await api(scope, receive, send)
+    else:
+        await _flask(scope, receive, send)
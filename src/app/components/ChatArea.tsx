@@ -66,19 +66,64 @@ const resolveApiBase = () => {
   return "";
 };
 
+const STREAM_MAX_RESUMES = 3;
+const WARMUP_INTERVAL_MS = 30_000;
+let lastWarmupAt = 0;
+
+// Let the backend open DB connections and load schema/memories while the user is still typing
+function warmupBackend() {
+  const now = Date.now();
+  if (now - lastWarmupAt < WARMUP_INTERVAL_MS) return;
+  lastWarmupAt = now;
+  fetch(`${resolveApiBase()}/warmup`, { method: "POST", keepalive: true }).catch(() => {});
+}
+
 async function streamToFlask(message: string, onDelta: (t: string) => void) {
   const apiBase = resolveApiBase();
-  const res = await fetch(`${apiBase}/chat_stream`, {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ message }),
-  });
-
-  if (!res.ok) {
-    const txt = await res.text();
-    throw new Error(txt || "Flask error");
+  const state: SseState = { lastEventId: null, done: false };
+  // Lets the backend tell a retried POST from a new question, so a turn never runs twice
+  const turnId = crypto.randomUUID();
+
+  // A dropped connection resumes the same answer from the last event we saw, or rejoins
+  // the turn by its id if it dropped before the first event
+  for (let attempt = 0; attempt <= STREAM_MAX_RESUMES; attempt++) {
+    const headers: Record<string, string> = { "Content-Type": "application/json" };
+    if (state.lastEventId) headers["Last-Event-ID"] = state.lastEventId;
+
+    let res: Response;
+    try {
+      res = await fetch(`${apiBase}/chat_stream`, {
+        method: "POST",
+        headers,
+        body: JSON.stringify(state.lastEventId ? {} : { message, turn_id: turnId }),
+      });
+    } catch (err) {
+      if (attempt === STREAM_MAX_RESUMES) throw err;
+      await new Promise((r) => setTimeout(r, 500 * (attempt + 1)));
+      continue;
+    }
+
+    if (!res.ok) {
+      const txt = await res.text();
+      throw new Error(txt || "Flask error");
+    }
+
+    try {
+      await readSseDeltas(res, onDelta, state);
+    } catch (err) {
+      if (attempt === STREAM_MAX_RESUMES) throw err;
+    }
+    if (state.done) return;
   }
+}
+
+type SseState = { lastEventId: string | null; done: boolean };
 
+async function readSseDeltas(
+  res: Response,
+  onDelta: (t: string) => void,
+  state: SseState = { lastEventId: null, done: false }
+) {
   const reader = res.body?.getReader();
   if (!reader) throw new Error("No stream reader");
 
@@ -99,6 +144,10 @@ async function streamToFlask(message: string, onDelta: (t: string) => void) {
       // each message has lines like: data: {...}
       const lines = chunk.split("\n");
       for (const line of lines) {
+        if (line.startsWith("id:")) {
+          state.lastEventId = line.slice(3).trim();
+          continue;
+        }
         if (!line.startsWith("data:")) continue;
 
         const jsonStr = line.replace(/^data:\s*/, "").trim();
@@ -106,7 +155,10 @@ async function streamToFlask(message: string, onDelta: (t: string) => void) {
 
         const payload = JSON.parse(jsonStr);
         if (payload.delta) onDelta(payload.delta);
-        if (payload.done) return;
+        if (payload.done) {
+          state.done = true;
+          return;
+        }
       }
     }
   }
@@ -356,28 +408,25 @@ const handleSendMessage = async () => {
   };
 
 
-   const sendScreenSnapshot = async (dataUrl: string, prompt: string, chatId: string, aiId: string) => {
+   const sendScreenSnapshot = async (image: Blob, prompt: string, chatId: string, aiId: string) => {
     try {
+      const formData = new FormData();
+      formData.append("image", image, "snapshot.jpg");
+      formData.append("prompt", "");
       const apiBase = resolveApiBase();
-      const response = await fetch(`${apiBase}/screen_snapshot`, {
+      const response = await fetch(`${apiBase}/screen_snapshot_stream`, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          image: dataUrl,
-          prompt: "",
-        }),
+        body: formData,
       });
-      const payload = await response.json().catch(() => ({}));
       if (!response.ok) {
+        const payload = await response.json().catch(() => ({}));
         throw new Error(payload?.error || "Screen share failed.");
       }
-      onUpdateChatMessages(chatId, (prev) =>
-        prev.map((msg) =>
-          msg.id === aiId
-            ? { ...msg, text: payload?.message || "I reviewed the screen snapshot." }
-            : msg
-        )
-      );
+      await readSseDeltas(response, (delta) => {
+        onUpdateChatMessages(chatId, (prev) =>
+          prev.map((msg) => (msg.id === aiId ? { ...msg, text: msg.text + delta } : msg))
+        );
+      });
     } catch (err: any) {
       onUpdateChatMessages(chatId, (prev) =>
         prev.map((msg) =>
@@ -400,8 +449,9 @@ const handleSendMessage = async () => {
     const context = canvas.getContext("2d");
     if (!context) return;
     context.drawImage(video, 0, 0, canvas.width, canvas.height);
-    const dataUrl = canvas.toDataURL("image/jpeg", 0.8);
-    await sendScreenSnapshot(dataUrl, prompt, chatId, aiId);  };
+    const image = await new Promise<Blob | null>((resolve) => canvas.toBlob(resolve, "image/jpeg", 0.8));
+    if (!image) return;
+    await sendScreenSnapshot(image, prompt, chatId, aiId);  };
 
   const stopScreenShare = () => {
     if (screenStreamRef.current) {
@@ -651,7 +701,11 @@ const handleSendMessage = async () => {
             <div className="relative flex-1">
               <Input
                 value={message}
-                onChange={(e) => setMessage(e.target.value)}
+                onChange={(e) => {
+                  setMessage(e.target.value);
+                  warmupBackend();
+                }}
+                onFocus={warmupBackend}
                 onKeyDown={handleKeyPress}
                 placeholder="Message Koko... (Enter to send, Shift+Enter for new line)"
                 className="pr-12 h-14 text-base border-gray-300 shadow-sm focus:ring-2 focus:ring-blue-500/20 rounded-xl"
@@ -0,0 +1,32 @@
+import json
+import sys
+
+sys.path.insert(0, ".")
+from app import run_sql, run_sql_columnar, _approx_tokens
+
+# Compares the old list-of-dicts query_sql payload with the columnar one on every public
+# table of the real database. Run from the repo root: py testing/columnar_savings.py [limit]
+
+LIMIT = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+tables = [r["table_name"] for r in run_sql(
+    "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name;"
+)]
+
+total_dict_bytes = total_col_bytes = total_dict_tokens = total_col_tokens = 0
+print(f"{'table':30} {'rows':>6} {'dict B':>9} {'col B':>9} {'saved':>6} {'dict tok':>9} {'col tok':>9} {'saved':>6}")
+for table in tables:
+    result = run_sql_columnar(f'SELECT * FROM "{table}" LIMIT {LIMIT}')
+    as_dicts = json.dumps({"rows": result.to_records()})
+    columnar = json.dumps(result.to_payload())
+    db, cb = len(as_dicts.encode("utf-8")), len(columnar.encode("utf-8"))
+    dt, ct = _approx_tokens(as_dicts), _approx_tokens(columnar)
+    total_dict_bytes += db
+    total_col_bytes += cb
+    total_dict_tokens += dt
+    total_col_tokens += ct
+    print(f"{table[:30]:30} {result.row_count:6d} {db:9d} {cb:9d} {1 - cb / db:6.0%} {dt:9d} {ct:9d} {1 - ct / dt:6.0%}")
+
+if total_dict_bytes:
+    print(f"\nTotal bytes saved: {1 - total_col_bytes / total_dict_bytes:.0%}, "
+          f"tokens saved (approx): {1 - total_col_tokens / total_dict_tokens:.0%}")
@@ -0,0 +1,85 @@
+import random
+import sys
+
+sys.path.insert(0, ".")
+from app import StreamingEmailFormatter, ensure_structured_email
+
+# Checks that StreamingEmailFormatter gives byte-identical output to ensure_structured_email
+# for every email in the corpus, fed in random-sized deltas, and reports how early the
+# Subject/greeting header came out. Run from the repo root: py testing/email_formatter.py [rounds]
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+CORPUS = [
+    # the format SYSTEM_PROMPT asks for
+    "Subject: Aurora staffing update\n\nHi Maria,\n\nAurora is fully staffed for December.\n\n"
+    "Two new hires start Monday.\n\nThank you,\nKoko 🐨\nHealthcare Plus",
+    # CRLF, extra blank lines, trailing spaces
+    "Subject: Q4 numbers  \r\n\r\n\r\nHi team,\r\n\r\nActive clients rose 4% 📊\r\n\r\n\r\nThanks,\r\nKoko\r\n",
+    # no subject, "Hello" greeting (kept in the body, like the batch formatter does)
+    "Hello Dr. Patel,\n\nThe report is attached.\nLet me know if anything looks off.\n\nBest,\nJordan",
+    # subject value on the next line
+    "Subject:\n\nFollow-up on intake forms\nHi Sam,\nPlease resend the forms.\nRegards,\nKoko",
+    # subject further down, greeting first
+    "Hi Alex,\nHere is the draft.\nSubject: Draft for review\nThe rest of the body.\nSincerely\nOps",
+    # nothing but body text
+    "Just a plain answer without any email scaffolding.",
+    # only scaffold: body falls back to the raw text
+    "Subject: Hi\nHi Bob,\nThanks,\nKoko",
+    # empty
+    "",
+    # indented first body line, sign-off without a following line
+    "Subject: Note\nHi Kim,\n    Indented first line.\n  second line  \nThank you,",
+    # several sign-off lines in a row
+    "Subject: Closing\nHi all,\nBody.\nThanks,\nBest,\nHealthcare Plus\n",
+    # greeting split over lines
+    "Subject: Split\nHi\n\nTaylor,\nBody line.\nThanks,\nKoko 🐨",
+    # subject line with only whitespace at the very end
+    "Hi there,\nBody here.\nSubject:   ",
+    # markdown-ish body with lists
+    "Subject: Weekly checklist ✅\n\nHi Jordan,\n\n- Review intake backlog\n- Confirm Aurora shifts\n\n"
+    "1. Title\n\nContent\n\nThank you,\nKoko 🐨\nHealthcare Plus\n",
+]
+
+
+def random_deltas(text: str, rng: random.Random):
+    i = 0
+    while i < len(text):
+        n = rng.choice([1, 1, 2, 3, 5, 8, 13, 40])
+        yield text[i:i + n]
+        i += n
+
+
+def main():
+    rng = random.Random(7)
+    failures = 0
+    header_at = []
+    for case, text in enumerate(CORPUS):
+        expected = ensure_structured_email(text)
+        for _ in range(ROUNDS):
+            fmt = StreamingEmailFormatter()
+            out, fed = "", 0
+            first_output_at = None
+            for delta in random_deltas(text, rng):
+                fed += len(delta)
+                piece = fmt.feed(delta)
+                if piece and first_output_at is None:
+                    first_output_at = fed
+                out += piece
+            out += fmt.finish()
+            if out != expected:
+                failures += 1
+                print(f"MISMATCH case {case}:\n--- expected\n{expected!r}\n--- streamed\n{out!r}")
+                break
+            if first_output_at is not None and text:
+                header_at.append(first_output_at / len(text))
+
+    print(f"{len(CORPUS)} emails x {ROUNDS} random splits: {failures} mismatches")
+    if header_at:
+        header_at.sort()
+        print(f"first output after {header_at[len(header_at) // 2]:.0%} of the text (median, when streamed early)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
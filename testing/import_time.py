@@ -0,0 +1,47 @@
+import os
+import re
+import subprocess
+import sys
+
+# Tracks cold-start cost of `import app`. Run from the repo root:
+#   py testing/import_time.py            (prints total + slowest imports)
+#   py testing/import_time.py 300        (also fails if total import time > 300 ms)
+
+BUDGET_MS = float(sys.argv[1]) if len(sys.argv) > 1 else None
+TOP_N = 15
+
+env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "import-time-check"))
+proc = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import app"],
+    capture_output=True,
+    text=True,
+    env=env,
+)
+if proc.returncode != 0:
+    print(proc.stderr)
+    sys.exit(proc.returncode)
+
+rows = []
+for line in proc.stderr.splitlines():
+    m = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+    if m:
+        rows.append((int(m.group(2)), len(m.group(3)), m.group(4)))
+
+# -X importtime prints children before their parent; app's subtree is the run of
+# deeper-indented lines directly above the "app" line.
+app_idx = next(i for i, (_, _, name) in enumerate(rows) if name == "app")
+total_us, app_depth = rows[app_idx][0], rows[app_idx][1]
+start = app_idx
+while start > 0 and rows[start - 1][1] > app_depth:
+    start -= 1
+
+total_ms = total_us / 1000
+print(f"import app: {total_ms:.1f} ms\n")
+print("Slowest direct imports of app.py:")
+direct = sorted((r for r in rows[start:app_idx] if r[1] == app_depth + 2), reverse=True)[:TOP_N]
+for cum, _, name in direct:
+    print(f"  {cum / 1000:8.1f} ms  {name}")
+
+if BUDGET_MS is not None and total_ms > BUDGET_MS:
+    print(f"\nOver budget: {total_ms:.1f} ms > {BUDGET_MS:.1f} ms")
+    sys.exit(1)
@@ -0,0 +1,28 @@
+import sys
+from collections import Counter
+
+sys.path.insert(0, ".")
+from app import get_db_targets, check_replicas, run_sql, _REPLICA_HEALTH
+
+# Shows where read traffic lands with PG_REPLICAS configured. Two local instances are enough:
+#   config.json: "PG_SSLMODE": "disable", "PG_REPLICAS": [{"PG_PORT": 5433}]
+# Run from the repo root: py testing/replica_routing.py [queries]
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+for name, settings in get_db_targets().items():
+    shown = {k: v for k, v in settings.items() if k != "password"}
+    print(f"{name:10} {shown}")
+
+check_replicas()
+for name, health in _REPLICA_HEALTH.items():
+    print(f"{name:10} ok={health['ok']} lag={health['lag']}")
+
+served = Counter()
+for i in range(N):
+    row = run_sql("SELECT inet_server_port() AS port, pg_is_in_recovery() AS replica;", replica=True)[0]
+    served[(row["port"], row["replica"])] += 1
+print(f"\n{N} replica=True queries served by (port, in_recovery): {dict(served)}")
+
+row = run_sql("SELECT inet_server_port() AS port, pg_is_in_recovery() AS replica;")[0]
+print(f"primary query served by port {row['port']} (in_recovery={row['replica']})")
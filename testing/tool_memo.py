@@ -0,0 +1,61 @@
+import json
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, ".")
+import app
+
+# Drives run_chat_turn with a scripted model that repeats its get_schema and query_sql calls
+# in the second round, so each tool runs once (memo miss) and is then answered from the
+# per-request memo (memo hit). No OpenAI key or database needed; audit records are kept in
+# memory. Run from the repo root: py testing/tool_memo.py
+
+CALLS = [("get_schema", {"mode": "tables"}), ("query_sql", {"query": "SELECT branch, clients FROM active_clients"})]
+ROUNDS = [CALLS, CALLS, "Aurora has 12 active clients."]
+
+tool_runs = {"get_schema": 0, "query_sql": 0}
+audited = []
+
+
+def fake_create_response(**kwargs):
+    step = ROUNDS[min(fake_create_response.round, len(ROUNDS) - 1)]
+    fake_create_response.round += 1
+    if isinstance(step, str):
+        return SimpleNamespace(output=[], output_text=step, usage=None, model="scripted")
+    output = [
+        SimpleNamespace(type="function_call", name=name, arguments=json.dumps(args), call_id=f"call_{i}")
+        for i, (name, args) in enumerate(step)
+    ]
+    return SimpleNamespace(output=output, output_text="", usage=None, model="scripted")
+
+
+def fake_get_schema(mode, table=None, column=None, limit=50):
+    tool_runs["get_schema"] += 1
+    return [{"table_name": "active_clients"}]
+
+
+def fake_run_model_sql(sql, params=None):
+    tool_runs["query_sql"] += 1
+    return {"columns": ["branch", "clients"], "rows": [["Aurora", 12], ["Denver", 9]], "row_count": 2}
+
+
+fake_create_response.round = 0
+app.create_response = fake_create_response
+app.get_schema = fake_get_schema
+app.run_model_sql = fake_run_model_sql
+app.match_sql_template = lambda user_text: None
+app.learn_sql_template = lambda user_text, sql: None
+app.audit = lambda event, **fields: audited.append({"event": event, **fields})
+
+text, last_sql = app.run_chat_turn("Show active clients by branch", [], "tool-memo")
+
+tool_calls = [r for r in audited if r["event"] == "tool_call"]
+for r in tool_calls:
+    print(f"{r['tool']:11} cache_hit={r['cache_hit']!s:5} rows={r['rows']} args={r.get('args')} sql={r.get('sql')}")
+print(f"answer: {text!r}")
+print(f"tool executions: {tool_runs}")
+
+hits = [r for r in tool_calls if r["cache_hit"] == "memo"]
+ok = text == ROUNDS[-1] and tool_runs == {"get_schema": 1, "query_sql": 1} and len(hits) == 2
+print("OK" if ok else "FAILED")
+sys.exit(0 if ok else 1)